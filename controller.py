@@ -1,69 +1,82 @@
 import asyncio
 import json
+import os
+import time
+import typing
 
 import quart
-import upnpy
 
 import heos
+import heos.discovery
 import heos.manager
+import heos.snapshot
+import heos.store
 
 app = quart.Quart("HEOS Communication Server", static_url_path='')
 app.secret_key = "HeosCommunication_ChangeThisKeyForInstallation"
 
-found_heos_devices = list()
+SSE_KEEP_ALIVE_INTERVAL = 15
+DISCOVERY_INTERVAL = 60
+STATE_FILE = os.environ.get('HEOS_STATE_FILE', 'heos_state.json.gz')
+
 heos_manager: heos.manager.HeosDeviceManager = None
+snapshot_cache = heos.snapshot.HeosSnapshotCache()
+state_store = heos.store.HeosStateStore(STATE_FILE)
+discovery = heos.discovery.HeosDiscoveryService(interval=DISCOVERY_INTERVAL, timeout=1)
 
 
 @app.before_serving
 async def _start_server():
     global heos_manager
     heos_manager = heos.manager.HeosDeviceManager()
+    discovery.manager = heos_manager
+    discovery.on_change = save_state
 
     loop = asyncio.get_event_loop()
-    loop.create_task(scan_for_devices(1))
-    await asyncio.sleep(1)
+    if await heos_manager.restore(state_store):
+        # served from the stored system right away, the speakers are asked again in the background
+        loop.create_task(revalidate_devices())
+    else:
+        discovery.start()
+        await asyncio.sleep(1)
 
 
 @app.after_serving
 async def _shut_down():
     global heos_manager
+    discovery.stop()
     await heos_manager.stop_watch_events()
+    await save_state()
+    heos.manager.HeosDeviceManager.connection_pool.close_all()
 
     await asyncio.sleep(2)
 
 
 async def scan_for_devices(timeout=2):
-    global found_heos_devices
-
-    upnp = upnpy.UPnP()
-    devices = upnp.discover(delay=timeout)
-    found_ips = list()
-    for device in devices:
-        if b"urn:schemas-denon-com:device:AiosServices:1" in device.description:
-            if not any(heos_dev['name'] == device.friendly_name for heos_dev in found_heos_devices):
-                append_device = {
-                    'name': device.friendly_name,
-                    'host': device.host,
-                    'port': device.port,
-                    'type': device.type_,
-                    'base_url': device.base_url,
-                    'services': []
-                }
-                found_ips.append(device.host)
-                for service in device.get_services():
-                    append_device['services'].append(
-                        {
-                            'service': service.service,
-                            'type': service.type_,
-                            'version': service.version,
-                            'base_url': service.base_url,
-                            'control_url': service.control_url
-                        })
-                found_heos_devices.append(append_device)
-    global heos_manager
-    if heos_manager:
-        await heos_manager.initialize(found_ips)
+    discovery.timeout = timeout
+    discovery.manager = heos_manager
+    await discovery.scan()
+
+
+async def save_state():
+    # an empty manager did not get far enough to know the system, the last stored one is kept
+    if not heos_manager or not heos_manager.get_all_devices():
+        return
+
+    try:
+        await heos_manager.save(state_store)
+    except OSError as e:
+        app.logger.warning("could not store the HEOS system in %s: %s", state_store.path, e)
+
+
+async def revalidate_devices():
+    try:
+        await heos_manager.revalidate()
         await heos_manager.start_watch_events()
+        await save_state()
+    finally:
+        # speakers which were added or moved meanwhile are found by the discovery
+        discovery.start()
 
 
 @app.route('/')
@@ -102,6 +115,7 @@ async def get_api():
         'heos-devices': quart.request.url_root[:-4] + "heos_devices/",
         'heos-sources': quart.request.url_root[:-4] + "heos_sources/",
         'heos-events-page': quart.request.url_root[:-4] + "event_test/",
+        'heos-stats': quart.request.url_root[:-4] + "heos_stats/",
         'heos-device': devicecommand,
         'heos-source': sourcecommand,
     }), 200, {'Content-Type': 'application/json; charset=utf-8'}
@@ -109,14 +123,25 @@ async def get_api():
 
 @app.route('/devices/')
 async def get_devices():
-    global found_heos_devices
-    return json.dumps(found_heos_devices), 200, {'Content-Type': 'application/json; charset=utf-8'}
+    return json.dumps(discovery.get_devices()), 200, {'Content-Type': 'application/json; charset=utf-8'}
+
+
+@app.route('/heos_stats/')
+async def get_heos_stats():
+    if not heos_manager:
+        return b'No Heos Manager found.', 404
+
+    return json.dumps({
+        'subscription': heos_manager.event_subscription.stats(),
+        'connections': heos_manager.connection_pool.stats(),
+        'events': heos_manager.event_stats.to_dict(),
+    }), 200, {'Content-Type': 'application/json; charset=utf-8'}
 
 
 def convert_to_dict(obj):
     obj_dict = dict()
     for key, value in obj.__class__.__dict__.items():
-        if not key.startswith("_") and not callable(value):
+        if not key.startswith("_") and not callable(value) and not isinstance(value, property):
             obj_dict[key] = value
     for key, value in obj.__dict__.items():
         if not key.startswith("_") and not callable(value):
@@ -124,6 +149,27 @@ def convert_to_dict(obj):
     return obj_dict
 
 
+def _get_fields_and_depth(args) -> typing.Tuple[typing.List[str], typing.Optional[int]]:
+    depth = args.get('depth', None, type=int)
+    return _get_list_arg(args, 'fields'), max(depth, 0) if depth is not None else None
+
+
+def get_snapshot_response(key: str, objects: typing.Iterable[heos.snapshot.HeosSnapshot], sort_keys: bool = False):
+    fields, depth = _get_fields_and_depth(quart.request.args)
+    if key == 'devices':
+        def encode(obj) -> bytes:
+            return json.dumps(obj.to_dict(fields), sort_keys=sort_keys).encode('utf-8')
+    else:
+        def encode(obj) -> bytes:
+            return json.dumps(obj.to_dict(fields, depth), sort_keys=sort_keys).encode('utf-8')
+
+    body, etag = snapshot_cache.get(f"{key}?fields={','.join(fields)}&depth={depth}", key, objects, encode)
+    if heos.snapshot.HeosSnapshotCache.matches(quart.request.headers.get('If-None-Match'), etag):
+        return b'', 304, {'ETag': etag}
+
+    return body, 200, {'Content-Type': 'application/json; charset=utf-8', 'ETag': etag}
+
+
 @app.route('/heos_devices/')
 async def get_heos_devices():
     global heos_manager
@@ -131,15 +177,15 @@ async def get_heos_devices():
     if not heos_manager:
         heos_manager = heos.manager.HeosDeviceManager()
 
-    result = heos_manager.get_all_devices()
-    return json.dumps(result, default=convert_to_dict), 200, {'Content-Type': 'application/json; charset=utf-8'}
+    return get_snapshot_response('devices', heos_manager.get_all_devices())
 
 
 @app.route('/heos_device/<name>/')
 async def get_heos_device(name):
     result = heos_manager.get_device_by_name(name)
     if result:
-        return json.dumps(result, default=convert_to_dict), 200, {'Content-Type': 'application/json; charset=utf-8'}
+        fields, _ = _get_fields_and_depth(quart.request.args)
+        return json.dumps(result.to_dict(fields)), 200, {'Content-Type': 'application/json; charset=utf-8'}
     else:
         return b'Device not found.', 404
 
@@ -151,26 +197,49 @@ async def get_volume(name):
 
     return str(device.volume), 200
 
-@app.route('/heos_device/<name>/<command>/')
-@app.route('/heos_device/<name>/<command>/<param>/')
-async def send_heos_command(name, command):
+
+@app.route('/heos_device/<name>/volume/<int:level>/')
+async def set_volume(name, level: int):
     device = heos_manager.get_device_by_name(name)
     if not device:
         return b'Device not found.', 404
 
-    if command not in ('play', 'pause', 'stop', 'volume_up', 'volume_down', 'next', 'prev'):
-        return b'Invalid command.', 404
+    successful, volume = await device.volume_control.set(level)
+    return json.dumps({
+        'successful': successful,
+        'volume': volume
+    }), 200, {'Content-Type': 'application/json; charset=utf-8'}
+
 
+DEVICE_COMMANDS = ('play', 'pause', 'stop', 'volume_up', 'volume_down', 'next', 'prev')
+
+
+async def run_device_command(device: heos.manager.HeosDevice, command: str) -> bool:
     successful = False
     if command in ('play', 'pause', 'stop'):
         successful = await device.set_play_state(command)
     elif command in ('volume_up', 'volume_down'):
-        successful = await device.set_volume(device.volume + 2 if command == 'volume_up' else device.volume - 2)
+        successful, _ = await device.volume_control.step(2 if command == 'volume_up' else -2)
     elif command == 'next':
         successful = await device.next_track()
     elif command == 'prev':
         successful = await device.prev_track()
 
+    return successful
+
+
+@app.route('/heos_device/<name>/<command>/')
+@app.route('/heos_device/<name>/<command>/<param>/')
+async def send_heos_command(name, command):
+    device = heos_manager.get_device_by_name(name)
+    if not device:
+        return b'Device not found.', 404
+
+    if command not in DEVICE_COMMANDS:
+        return b'Invalid command.', 404
+
+    successful = await run_device_command(device, command)
+
     return json.dumps({
         'successful': successful
     }), 200, {'Content-Type': 'application/json; charset=utf-8'}
@@ -180,7 +249,7 @@ async def send_heos_command(name, command):
 async def get_heos_sources():
     result = heos_manager.get_all_sources()
     if result:
-        return json.dumps(result, default=convert_to_dict, sort_keys=True), 200, {'Content-Type': 'application/json; charset=utf-8'}
+        return get_snapshot_response('sources', result, sort_keys=True)
     else:
         return b'No Heos Source found.', 404
 
@@ -198,9 +267,23 @@ async def get_heos_source_container(sid: int, cid: str = ""):
         if not result:
             return b'No Heos Source container found.', 404
 
-        await result.browse(1)
+    fields, depth = _get_fields_and_depth(quart.request.args)
+    offset = quart.request.args.get('offset', None, type=int)
+    limit = quart.request.args.get('limit', None, type=int)
+    if offset is None and limit is None and not cid:
+        return json.dumps(result.to_dict(fields, depth)), 200, {'Content-Type': 'application/json; charset=utf-8'}
+
+    # a single page of a large container, without loading the rest of it, the first one by default
+    offset = max(offset or 0, 0)
+    children, count = await result.browse_range(offset, max(limit, 0) if limit is not None else result.page_size)
+    data = result.to_dict(fields, 0)
+    if not fields or "children" in fields:
+        child_depth = None if depth is None else max(depth - 1, 0)
+        data["children"] = {child._id: child.to_dict(fields, child_depth) for child in children}
+    data["offset"] = offset
+    data["count"] = count
 
-    return json.dumps(result, default=convert_to_dict), 200, {'Content-Type': 'application/json; charset=utf-8'}
+    return json.dumps(data), 200, {'Content-Type': 'application/json; charset=utf-8'}
 
 
 @app.route('/event_test/')
@@ -208,20 +291,78 @@ async def get_events_dummy_template():
     return await quart.render_template('events_dummy.html')
 
 
-@app.route('/heos_events/')
-async def get_heos_event_stream():
-    event_queue = heos.EventQueueManager.get_queue()
+def _prepare_burst(burst: typing.List[heos.ServerHeosEvent], event_filter: typing.Optional[heos.EventFilter],
+                   coalesce: float) -> typing.List[heos.ServerHeosEvent]:
+    if event_filter:
+        burst = [event for event in burst if event_filter.matches(event)]
+    if coalesce:
+        burst = heos.coalesce_events(burst)
+    return burst
 
-    async def send_events():
+
+async def stream_events(subscriber: heos.EventSubscriber, keep_alive: float = SSE_KEEP_ALIVE_INTERVAL,
+                        slim: bool = False, event_filter: heos.EventFilter = None, coalesce: float = 0.0):
+    last_write = time.monotonic()
+    try:
         while True:
-            if not event_queue.empty():
-                event = await event_queue.get()
-                yield event.encode()
+            try:
+                event = await asyncio.wait_for(subscriber.get(), keep_alive)
+            except asyncio.TimeoutError:
+                yield b': keep-alive\n\n'
+                last_write = time.monotonic()
+                continue
+
+            if coalesce:
+                await asyncio.sleep(coalesce)
+
+            # everything which arrived meanwhile goes out in the same write
+            burst = [event]
+            while not subscriber.empty():
+                burst.append(subscriber.get_nowait())
+
+            burst = _prepare_burst(burst, event_filter, coalesce)
+            if burst:
+                yield b''.join(event.encode(slim) for event in burst)
+                last_write = time.monotonic()
+            elif time.monotonic() - last_write > keep_alive:
+                yield b': keep-alive\n\n'
+                last_write = time.monotonic()
+    except heos.SubscriberDisconnected as e:
+        # the client learns why the server ended the stream, e.g. it fell too far behind
+        yield f": disconnected: {e.reason}\n\n".encode('utf-8')
+    finally:
+        subscriber.close()
+
+
+def _get_list_arg(args, name: str) -> typing.List[str]:
+    return [value for values in args.getlist(name) for value in values.split(',') if value]
+
+
+def _get_event_filter() -> heos.EventFilter:
+    args = quart.websocket.args if quart.has_websocket_context() else quart.request.args
+    return heos.EventFilter(
+        pids=(int(pid) for pid in _get_list_arg(args, 'pid') if pid.lstrip('-').isdigit()),
+        events=_get_list_arg(args, 'event'),
+        groups=(int(gid) for gid in _get_list_arg(args, 'gid') + _get_list_arg(args, 'group')
+                if gid.lstrip('-').isdigit()))
+
 
-            await asyncio.sleep(0.3)
+@app.route('/heos_events/')
+async def get_heos_event_stream():
+    last_event_id = quart.request.headers.get('Last-Event-ID', quart.request.args.get('last_event_id'))
+    policy = quart.request.args.get('policy', heos.EventSubscriber.DROP_OLDEST)
+    if policy not in (heos.EventSubscriber.DROP_OLDEST, heos.EventSubscriber.DISCONNECT):
+        return b'Invalid policy.', 400
+
+    subscriber = heos.EventQueueManager.subscribe(
+        policy, last_event_id=int(last_event_id) if last_event_id and last_event_id.isdigit() else None)
 
     response = await quart.make_response(
-        send_events(),
+        stream_events(
+            subscriber,
+            slim=quart.request.args.get('slim', '') in ('1', 'true', 'yes'),
+            event_filter=_get_event_filter(),
+            coalesce=quart.request.args.get('coalesce', 0, type=int) / 1000),
         {
             'Content-Type': 'text/event-stream',
             'Cache-Control': 'no-cache',
@@ -233,5 +374,78 @@ async def get_heos_event_stream():
     return response
 
 
+async def handle_websocket_command(message: dict) -> dict:
+    command = message.get('command')
+    if command == 'browse':
+        result = heos_manager.get_source_by_id(message.get('sid', 0))
+        if result and message.get('cid'):
+            result = result.get_container(message['cid'])
+            if result:
+                await result.browse_range(0, result.page_size)
+
+        if not result:
+            return {'successful': False, 'error': 'No Heos Source found.'}
+        return {'successful': True, 'result': result.to_dict(message.get('fields'), message.get('depth'))}
+
+    device = heos_manager.get_device_by_name(message.get('device')) if heos_manager else None
+    if not device:
+        return {'successful': False, 'error': 'Device not found.'}
+
+    if command == 'state':
+        return {'successful': True, 'result': device.to_dict(message.get('fields'))}
+    if command == 'volume':
+        successful, volume = await device.volume_control.set(int(message.get('level', device.volume)))
+        return {'successful': successful, 'volume': volume}
+    if command in DEVICE_COMMANDS:
+        return {'successful': await run_device_command(device, command)}
+
+    return {'successful': False, 'error': 'Invalid command.'}
+
+
+async def _answer_websocket_command(websocket, raw_message):
+    message = None
+    try:
+        message = json.loads(raw_message)
+        reply = await handle_websocket_command(message)
+    except Exception as e:
+        # every command gets its reply, also when the speaker failed or did not answer
+        reply = {'successful': False, 'error': str(e) or type(e).__name__}
+
+    reply['type'] = 'reply'
+    reply['id'] = message.get('id') if isinstance(message, dict) else None
+    await websocket.send(json.dumps(reply, default=convert_to_dict))
+
+
+async def _send_websocket_events(websocket, subscriber: heos.EventSubscriber, event_filter: heos.EventFilter,
+                                 slim: bool):
+    try:
+        while True:
+            event = await subscriber.get()
+            if not event_filter or event_filter.matches(event):
+                await websocket.send(event.encode_json(slim))
+    except heos.SubscriberDisconnected:
+        return
+
+
+@app.websocket('/heos_ws/')
+async def heos_websocket():
+    # commands and events share one connection, replies carry the id of their command
+    websocket = quart.websocket._get_current_object()
+    subscriber = heos.EventQueueManager.subscribe()
+    tasks = {asyncio.ensure_future(_send_websocket_events(
+        websocket, subscriber, _get_event_filter(), quart.websocket.args.get('slim', '') in ('1', 'true', 'yes')))}
+
+    try:
+        while True:
+            raw_message = await websocket.receive()
+            task = asyncio.ensure_future(_answer_websocket_command(websocket, raw_message))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        subscriber.close()
+        for task in tasks:
+            task.cancel()
+
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', debug=False)
@@ -1,37 +1,198 @@
 import asyncio
 import typing
 import json
+import weakref
+
+import heos.protocol
 
 
 class ServerHeosEvent:
     def __init__(self, data, event: str = 'event', identifier: int = 1, retry: int = 1):
         self.data = data
         self.event = event
-        self.id = identifier
+        self._id = identifier
         self.retry = retry
+        self._encoded: typing.Dict[typing.Any, typing.Union[bytes, str]] = dict()
+
+    @property
+    def id(self) -> int:
+        return self._id
+
+    @id.setter
+    def id(self, identifier: int):
+        self._id = identifier
+        self._encoded.clear()
+
+    def encode(self, slim: bool = False) -> bytes:
+        # encoded once and shared by every subscriber
+        if slim not in self._encoded:
+            data = self.data
+            if slim and isinstance(data, dict) and "full" in data:
+                data = {key: value for key, value in data.items() if key != "full"}
+
+            json_data = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+            self._encoded[slim] = f"id: {self._id}\nEvent: {self.event}\ndata: {json_data}\n\n".encode('utf-8')
+
+        return self._encoded[slim]
+
+    def encode_json(self, slim: bool = False) -> str:
+        # websocket frame, cached like the SSE frame
+        if ('json', slim) not in self._encoded:
+            data = self.data
+            if slim and isinstance(data, dict) and "full" in data:
+                data = {key: value for key, value in data.items() if key != "full"}
+
+            self._encoded[('json', slim)] = json.dumps(
+                {"type": self.event, "id": self._id, "data": data}, ensure_ascii=False, separators=(',', ':'))
+
+        return self._encoded[('json', slim)]
+
+
+class EventFilter:
+    def __init__(self, pids: typing.Iterable[int] = (), events: typing.Iterable[str] = (),
+                 groups: typing.Iterable[int] = ()):
+        self.pids = frozenset(pids)
+        self.events = frozenset(events)
+        self.groups = frozenset(groups)
+
+    def __bool__(self) -> bool:
+        return bool(self.pids or self.events or self.groups)
+
+    def matches(self, event: ServerHeosEvent) -> bool:
+        data = event.data if isinstance(event.data, dict) else dict()
+
+        if self.events and data.get("event") not in self.events:
+            return False
+
+        if self.pids or self.groups:
+            message = heos.protocol.HeosMessage.parse(data.get("message", ""))
+            return message.get_int("pid") in self.pids or message.get_int("gid") in self.groups
+
+        return True
+
+
+COALESCED_EVENTS = ('player_now_playing_progress', 'player_volume_changed', 'group_volume_changed')
+
+
+def coalesce_events(events: typing.List[ServerHeosEvent]) -> typing.List[ServerHeosEvent]:
+    # progress and volume events only matter with their latest value per player or group
+    latest = dict()
+    for index, event in enumerate(events):
+        data = event.data if isinstance(event.data, dict) else dict()
+        if data.get("event") in COALESCED_EVENTS:
+            message = heos.protocol.HeosMessage.parse(data.get("message", ""))
+            latest[(data["event"], message.get("pid"), message.get("gid"))] = index
+
+    keep = set(latest.values())
+    return [event for index, event in enumerate(events)
+            if index in keep or not isinstance(event.data, dict) or event.data.get("event") not in COALESCED_EVENTS]
+
 
-    def encode(self) -> bytes:
-        message = f"Event: {self.event}"
-        json_data = json.dumps(self.data, indent=2, ensure_ascii=False)
-        for line in json_data.splitlines():
-            message += f"\ndata: {line}"
-        message += "\n\n"
-        return message.encode('utf-8')
+class SubscriberDisconnected(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class EventSubscriber:
+    DROP_OLDEST = 'drop_oldest'
+    DISCONNECT = 'disconnect'
+
+    def __init__(self, cursor: int, policy: str = DROP_OLDEST):
+        if policy not in (EventSubscriber.DROP_OLDEST, EventSubscriber.DISCONNECT):
+            raise ValueError(f"unknown slow subscriber policy: {policy}")
+
+        self.cursor = cursor
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+        self.reason = ""
+
+    @property
+    def lag(self) -> int:
+        return EventQueueManager._next_index - self.cursor
+
+    def empty(self) -> bool:
+        return not self.closed and self.lag <= 0
+
+    def close(self, reason: str = "closed"):
+        if not self.closed:
+            self.closed = True
+            self.reason = reason
+            EventQueueManager._subscribers.discard(self)
+            EventQueueManager._wake()
+
+    def get_nowait(self) -> ServerHeosEvent:
+        if self.closed:
+            raise SubscriberDisconnected(self.reason)
+
+        if self.lag > EventQueueManager.buffer_size:
+            if self.policy == EventSubscriber.DISCONNECT:
+                self.close(f"slow subscriber, {self.lag} events behind")
+                raise SubscriberDisconnected(self.reason)
+
+            # the oldest events of this subscriber were overwritten already
+            skipped = self.lag - EventQueueManager.buffer_size
+            self.dropped += skipped
+            self.cursor += skipped
+
+        if self.lag <= 0:
+            raise asyncio.QueueEmpty()
+
+        event = EventQueueManager._buffer[self.cursor % EventQueueManager.buffer_size]
+        self.cursor += 1
+        return event
+
+    async def get(self) -> ServerHeosEvent:
+        while self.empty():
+            await EventQueueManager._wait()
+
+        return self.get_nowait()
 
 
 class EventQueueManager:
-    _queues = list()  # type: typing.List[asyncio.Queue]
+    buffer_size = 2048
+    _buffer = [None] * buffer_size  # type: typing.List[typing.Optional[ServerHeosEvent]]
+    _next_index = 0
+    _subscribers = weakref.WeakSet()  # type: typing.MutableSet[EventSubscriber]
+    _waiter = None  # type: typing.Optional[asyncio.Future]
 
     @staticmethod
     def add_event(event: ServerHeosEvent):
-        for queue in EventQueueManager._queues:  # type: asyncio.Queue
-            if queue.full():
-                EventQueueManager._queues.remove(queue)
-            else:
-                queue.put_nowait(event)
+        # ids count from 1 and follow the position in the stream, so a client can resume from them
+        event.id = EventQueueManager._next_index + 1
+        EventQueueManager._buffer[EventQueueManager._next_index % EventQueueManager.buffer_size] = event
+        EventQueueManager._next_index += 1
+
+        for subscriber in list(EventQueueManager._subscribers):
+            if subscriber.policy == EventSubscriber.DISCONNECT and subscriber.lag > EventQueueManager.buffer_size:
+                subscriber.close(f"slow subscriber, {subscriber.lag} events behind")
+
+        EventQueueManager._wake()
 
     @staticmethod
-    def get_queue() -> asyncio.Queue:
-        queue = asyncio.Queue(maxsize=2048)
-        EventQueueManager._queues.append(queue)
-        return queue
+    def _wake():
+        waiter = EventQueueManager._waiter
+        EventQueueManager._waiter = None
+        if waiter and not waiter.done():
+            waiter.set_result(None)
+
+    @staticmethod
+    async def _wait():
+        loop = asyncio.get_event_loop()
+        waiter = EventQueueManager._waiter
+        if waiter is None or waiter.done() or waiter.get_loop() is not loop:
+            waiter = EventQueueManager._waiter = loop.create_future()
+
+        # shielded, a cancelled subscriber must not cancel the future shared with the others
+        await asyncio.shield(waiter)
+
+    @staticmethod
+    def subscribe(policy: str = EventSubscriber.DROP_OLDEST, last_event_id: int = None) -> EventSubscriber:
+        cursor = EventQueueManager._next_index
+        if last_event_id is not None:
+            cursor = min(max(last_event_id, 0), cursor)
+
+        subscriber = EventSubscriber(cursor, policy)
+        EventQueueManager._subscribers.add(subscriber)
+        return subscriber
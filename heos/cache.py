@@ -0,0 +1,70 @@
+import collections
+import time
+import typing
+
+BrowseKey = typing.Tuple[int, str, int, int]
+# expiry time, payload and count of a cached page
+BrowseEntry = typing.Tuple[float, list, typing.Optional[int]]
+
+
+class HeosBrowseCache:
+    def __init__(self, default_ttl: float = 60.0, max_items: int = 20000):
+        self.default_ttl = default_ttl
+        self.max_items = max_items
+        # seconds a browse result of a source stays valid, 0 disables caching for it
+        self.ttls: typing.Dict[int, float] = dict()
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = collections.OrderedDict()  # type: typing.MutableMapping[BrowseKey, BrowseEntry]
+        self._items = 0
+
+    def get(self, key: BrowseKey) -> typing.Optional[typing.Tuple[list, typing.Optional[int]]]:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            self._remove(key)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def put(self, key: BrowseKey, payload: list, count: typing.Optional[int]):
+        ttl = self.ttls.get(key[0], self.default_ttl)
+        if ttl <= 0:
+            return
+
+        self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, payload, count)
+        self._items += len(payload)
+
+        # the least recently used pages go first, the newest page always stays
+        while self._items > self.max_items and len(self._entries) > 1:
+            _, (_, old_payload, _) = self._entries.popitem(last=False)
+            self._items -= len(old_payload)
+
+    def _remove(self, key: BrowseKey):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._items -= len(entry[1])
+
+    def invalidate(self, sid: int = None):
+        if sid is None:
+            self._entries.clear()
+            self._items = 0
+            return
+
+        for key in [key for key in self._entries if key[0] == sid]:
+            self._remove(key)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "items": self._items,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
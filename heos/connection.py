@@ -0,0 +1,274 @@
+import asyncio
+import collections
+import itertools
+import time
+import typing
+
+import heos.protocol
+
+HEOS_CLI_PORT = 1255
+STREAM_LIMIT = 2 ** 24  # browse results of big libraries exceed the default 64 KiB
+STREAM_CHUNK_SIZE = 2 ** 16
+
+
+class HeosConnection:
+    def __init__(self, ip: str, port: int = HEOS_CLI_PORT, timeout: float = 10.0):
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        self.last_used = 0.0
+        self.last_received = 0.0
+        self._reader: typing.Optional[asyncio.StreamReader] = None
+        self._writer: typing.Optional[asyncio.StreamWriter] = None
+        self._decoder = heos.protocol.HeosFrameDecoder()
+        self._messages: typing.Deque[dict] = collections.deque()
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def open(self):
+        self._decoder = heos.protocol.HeosFrameDecoder()
+        self._messages.clear()
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.ip, self.port, limit=STREAM_LIMIT), self.timeout)
+        self.last_used = time.monotonic()
+
+    def close(self):
+        if self._writer:
+            self._writer.close()
+        self._reader = None
+        self._writer = None
+
+    def is_healthy(self) -> bool:
+        # the speaker closed the socket if the reader already got the eof
+        return self.is_open and not self._reader.at_eof()
+
+    async def write(self, command: bytes):
+        self._writer.write(command + b"\n")
+        await self._writer.drain()
+        self.last_used = time.monotonic()
+
+    async def read_message(self, timeout: float = None) -> dict:
+        # without a timeout this waits until the speaker sends something
+        while not self._messages:
+            data = await asyncio.wait_for(self._reader.read(STREAM_CHUNK_SIZE), timeout)
+            self.last_received = time.perf_counter()
+            if not data:
+                raise EOFError(f"HEOS CLI connection to {self.ip} closed")
+            self._messages.extend(self._decoder.feed(data))
+
+        self.last_used = time.monotonic()
+        return self._messages.popleft()
+
+
+class HeosRequest:
+    def __init__(self, sequence: int, command: bytes, future: asyncio.Future):
+        self.sequence = sequence
+        self.command = command.split(b'?')[0][len(b'heos://'):].decode()
+        self.future = future
+        self.interim_replies = 0
+        self.has_interim = False
+
+
+class HeosPipelinedClient:
+    def __init__(self, ip: str, port: int = HEOS_CLI_PORT, timeout: float = 10.0, max_in_flight: int = 8):
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.last_used = time.monotonic()
+        self.reconnects = 0
+        # a request without any answer in time is followed by a heart beat, which has this long
+        self.probe_timeout = min(timeout, 2.0)
+
+        self._connection: typing.Optional[HeosConnection] = None
+        self._reader_task: typing.Optional[asyncio.Task] = None
+        self._requests: typing.Dict[int, HeosRequest] = dict()
+        self._sequence = itertools.count(1)
+        self._slots: typing.Optional[asyncio.Semaphore] = None
+        self._open_lock: typing.Optional[asyncio.Lock] = None
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._requests)
+
+    @property
+    def is_open(self) -> bool:
+        return self._connection is not None and self._connection.is_open
+
+    def is_healthy(self) -> bool:
+        return self.is_open and self._connection.is_healthy() \
+               and self._reader_task is not None and not self._reader_task.done()
+
+    async def open(self):
+        if self._open_lock is None:
+            self._open_lock = asyncio.Lock()
+
+        async with self._open_lock:
+            if self.is_healthy():
+                return
+
+            if self._connection:
+                self.close()
+                self.reconnects += 1
+
+            connection = HeosConnection(self.ip, self.port, self.timeout)
+            await connection.open()
+            self._connection = connection
+            self._reader_task = asyncio.ensure_future(self._read_loop(connection))
+
+    def close(self):
+        if self._reader_task:
+            self._reader_task.cancel()
+        if self._connection:
+            self._connection.close()
+        self._fail_requests(ConnectionError(f"HEOS CLI connection to {self.ip} closed"))
+
+    @staticmethod
+    def tag_command(command: bytes, sequence: int) -> bytes:
+        return command + (b'&' if b'?' in command else b'?') + b'SEQUENCE=' + str(sequence).encode()
+
+    async def request(self, command: bytes, timeout: float = None) -> dict:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+
+        async with self._slots:
+            if not self.is_healthy():
+                await self.open()
+
+            request = HeosRequest(next(self._sequence), command, asyncio.get_event_loop().create_future())
+            self._requests[request.sequence] = request
+            try:
+                await self._connection.write(self.tag_command(command, request.sequence))
+                while True:
+                    try:
+                        return await asyncio.wait_for(asyncio.shield(request.future), timeout or self.timeout)
+                    except asyncio.TimeoutError:
+                        # the speaker confirmed it is still working on it, so give it another period
+                        if request.has_interim:
+                            request.has_interim = False
+                            continue
+
+                        # a half open socket would make every later request wait the whole timeout as well
+                        if not await self._probe():
+                            self.close()
+                        raise
+            finally:
+                self._requests.pop(request.sequence, None)
+                self.last_used = time.monotonic()
+
+    async def _probe(self) -> bool:
+        if not self.is_healthy():
+            return False
+
+        request = HeosRequest(next(self._sequence), b'heos://system/heart_beat',
+                              asyncio.get_event_loop().create_future())
+        self._requests[request.sequence] = request
+        try:
+            await self._connection.write(self.tag_command(b'heos://system/heart_beat', request.sequence))
+            await asyncio.wait_for(request.future, self.probe_timeout)
+            return True
+        except (asyncio.TimeoutError, OSError, EOFError):
+            return False
+        finally:
+            self._requests.pop(request.sequence, None)
+
+    def _find_request(self, data: dict) -> typing.Optional[HeosRequest]:
+        message = heos.protocol.HeosMessage.parse(data.get("heos", {}).get("message", ""))
+        sequence = message.get_int("SEQUENCE")
+        if sequence is not None:
+            return self._requests.get(sequence)
+
+        # speakers without SEQUENCE support, fall back to the oldest request with the same command
+        command = data.get("heos", {}).get("command", "").strip()
+        for request in self._requests.values():
+            if request.command == command:
+                return request
+
+        return None
+
+    def _dispatch(self, data: dict):
+        request = self._find_request(data)
+        if not request or request.future.done():
+            return
+
+        if data["heos"].get("message", "").startswith("command under process"):
+            request.interim_replies += 1
+            request.has_interim = True
+        else:
+            request.future.set_result(data)
+
+    def _fail_requests(self, error: Exception):
+        for request in self._requests.values():
+            if not request.future.done():
+                request.future.set_exception(error)
+
+    async def _read_loop(self, connection: HeosConnection):
+        try:
+            while True:
+                self._dispatch(await connection.read_message())
+        except (EOFError, ConnectionError, heos.protocol.HeosProtocolError) as e:
+            connection.close()
+            self._fail_requests(ConnectionError(f"HEOS CLI connection to {self.ip} lost: {e}"))
+
+
+class HeosConnectionPool:
+    def __init__(self, max_connections_per_ip: int = 2, idle_timeout: float = 60.0, port: int = HEOS_CLI_PORT,
+                 timeout: float = 10.0, max_in_flight: int = 8):
+        self.max_connections_per_ip = max_connections_per_ip
+        self.idle_timeout = idle_timeout
+        self.port = port
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+
+        self._clients: typing.Dict[str, typing.List[HeosPipelinedClient]] = dict()
+        self._retired_reconnects = 0
+
+    def _get_client(self, ip: str) -> HeosPipelinedClient:
+        clients = self._clients.setdefault(ip, [])
+        if clients:
+            client = min(clients, key=lambda c: c.in_flight)
+            if client.in_flight < client.max_in_flight or len(clients) >= self.max_connections_per_ip:
+                return client
+
+        client = HeosPipelinedClient(ip, self.port, self.timeout, self.max_in_flight)
+        clients.append(client)
+        return client
+
+    async def request(self, ip: str, command: bytes) -> dict:
+        self.evict_idle()
+
+        client = self._get_client(ip)
+        try:
+            return await client.request(command)
+        except (EOFError, ConnectionError):
+            # speaker dropped the socket, retry once on a fresh one
+            return await client.request(command)
+
+    def evict_idle(self):
+        now = time.monotonic()
+        for clients in self._clients.values():
+            for client in list(clients):
+                if not client.in_flight and now - client.last_used > self.idle_timeout:
+                    clients.remove(client)
+                    self._retire(client)
+
+    def _retire(self, client: HeosPipelinedClient):
+        client.close()
+        self._retired_reconnects += client.reconnects
+
+    def close_all(self):
+        for clients in self._clients.values():
+            for client in clients:
+                self._retire(client)
+        self._clients = dict()
+
+    def stats(self) -> dict:
+        clients = [client for clients in self._clients.values() for client in clients]
+        return {
+            "open": sum(1 for client in clients if client.is_open),
+            "idle": sum(1 for client in clients if client.is_open and not client.in_flight),
+            "in_flight": sum(client.in_flight for client in clients),
+            "reconnects": self._retired_reconnects + sum(client.reconnects for client in clients),
+        }
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import typing
+
+import upnpy
+import upnpy.utils
+
+HEOS_DEVICE_TYPE = b"urn:schemas-denon-com:device:AiosServices:1"
+
+logger = logging.getLogger(__name__)
+
+
+class HeosDiscoveryService:
+    def __init__(self, manager=None, interval: float = 60.0, timeout: float = 2.0, lost_after: int = 3,
+                 on_change: typing.Callable[[], typing.Awaitable] = None):
+        self.manager = manager
+        self.interval = interval
+        self.timeout = timeout
+        # ssdp answers get lost now and then, a speaker counts as gone after this many scans without it
+        self.lost_after = lost_after
+        self.on_change = on_change
+
+        self.devices: typing.Dict[str, dict] = dict()
+        self.devices_by_ip: typing.Dict[str, dict] = dict()
+        self._missed: typing.Dict[str, int] = dict()
+
+        self._running = False
+        self._task: typing.Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _describe(device) -> dict:
+        usn = upnpy.utils.parse_http_header(device.response, 'USN') or ""
+        return {
+            'udn': usn.split('::')[0] or device.host,
+            'name': device.friendly_name,
+            'host': device.host,
+            'port': device.port,
+            'type': device.type_,
+            'base_url': device.base_url,
+            'services': [{
+                'service': service.service,
+                'type': service.type_,
+                'version': service.version,
+                'base_url': service.base_url,
+                'control_url': service.control_url
+            } for service in device.get_services()]
+        }
+
+    @staticmethod
+    def _discover(timeout: float) -> typing.List[dict]:
+        # blocking: the m-search waits for answers and every answer fetches its description over http
+        return [HeosDiscoveryService._describe(device) for device in upnpy.UPnP().discover(delay=timeout)
+                if isinstance(device.description, bytes) and HEOS_DEVICE_TYPE in device.description]
+
+    def get_devices(self) -> typing.List[dict]:
+        return list(self.devices.values())
+
+    async def scan(self) -> typing.Tuple[typing.List[dict], typing.List[dict]]:
+        found = await asyncio.get_event_loop().run_in_executor(None, self._discover, self.timeout)
+        found = {device['udn']: device for device in found}
+
+        new = [device for udn, device in found.items() if udn not in self.devices]
+        # a known speaker with a new address, e.g. from dhcp, is announced again so the manager follows it
+        moved = [device for udn, device in found.items()
+                 if udn in self.devices and self.devices[udn]['host'] != device['host']]
+        lost = list()
+        for udn, device in self.devices.items():
+            if udn in found:
+                self._missed.pop(udn, None)
+                continue
+
+            self._missed[udn] = self._missed.get(udn, 0) + 1
+            if self._missed[udn] >= self.lost_after:
+                lost.append(device)
+
+        if self.manager and (new or moved or lost):
+            # nothing is recorded before the manager took the changes, a failed announce is repeated by the next scan
+            await self._announce(new, moved, lost, found)
+            known_ips = set(device.ip for device in self.manager.get_all_devices())
+            skipped = [device['udn'] for device in new + moved if device['host'] not in known_ips]
+            new = [device for device in new if device['host'] in known_ips]
+            for udn in skipped:
+                found.pop(udn)
+
+        for device in lost:
+            self._missed.pop(device['udn'])
+            self.devices.pop(device['udn'])
+        # known speakers keep their entry, but take over a changed ip or name
+        self.devices.update(found)
+        self.devices_by_ip = {device['host']: device for device in self.devices.values()}
+
+        if self.manager and not self.manager.watch_enabled:
+            # no speaker answered the subscription so far, every scan tries again
+            await self.manager.start_watch_events()
+
+        return new, lost
+
+    async def _announce(self, new: typing.List[dict], moved: typing.List[dict], lost: typing.List[dict],
+                        found: typing.Dict[str, dict]):
+        for device in moved:
+            self.manager.replace_ip(self.devices[device['udn']]['host'], device['host'])
+        if new or moved:
+            await self.manager.initialize([device['host'] for device in new + moved])
+
+        lost_udns = set(device['udn'] for device in lost)
+        remaining_ips = set(device['host'] for udn, device in dict(self.devices, **found).items()
+                            if udn not in lost_udns)
+        lost_ips = [device['host'] for device in lost if device['host'] not in remaining_ips]
+        if lost_ips:
+            await self.manager.forget_ips(lost_ips)
+
+        if self.on_change:
+            await self.on_change()
+
+    async def _run(self):
+        while self._running:
+            try:
+                await self.scan()
+            except Exception:
+                # no network or a speaker which went away while it was asked, the next round tries again
+                logger.exception("HEOS discovery scan failed")
+
+            if self.manager:
+                # sockets to speakers nobody talks to any more are closed even without new requests
+                self.manager.connection_pool.evict_idle()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        self._running = False
+        if self._task:
+            self._task.cancel()
@@ -1,28 +1,96 @@
-import ast
 import asyncio
-import inspect
-import json
-import re
-import telnetlib
+import functools
+import logging
 import typing
 
 import heos
+import heos.connection
+import heos.protocol
+import heos.scheduler
+import heos.snapshot
 import heos.sources
+import heos.store
+import heos.subscription
+
+logger = logging.getLogger(__name__)
 
 
 class HeosEventCallback:
-    def __init__(self, name: str, param_names: list = []):
+    # handlers of every decorated class, keyed by "<module>.<class qualname>"
+    registry: typing.Dict[str, typing.List["HeosEventCallback"]] = dict()
+
+    def __init__(self, name: str, param_names: list = [], background: bool = False):
         self.name = name
-        self.param_names = param_names
+        self.param_names = tuple(param_names)
+        # slow handlers run outside of the subscription, which goes on reading events meanwhile
+        self.background = background
+        self.func_name = ""
 
     def __call__(self, func, *args, **kwargs):
         def new_func(*args, **kwargs):
             return func(*args, **kwargs)
 
+        self.func_name = func.__name__
+        owner = func.__module__ + "." + func.__qualname__.rsplit(".", 1)[0]
+        HeosEventCallback.registry.setdefault(owner, []).append(self)
+
+        new_func.heos_event_callback = self
         return new_func
 
+    def get_params(self, message: heos.protocol.HeosMessage) -> typing.Optional[list]:
+        params = [message.get(param) for param in self.param_names]
+        return None if None in params else params
+
+    @staticmethod
+    def get_callbacks(cls) -> typing.Dict[str, "HeosEventCallback"]:
+        callbacks = dict()
+        for klass in reversed(cls.__mro__):
+            for callback in HeosEventCallback.registry.get(klass.__module__ + "." + klass.__qualname__, []):
+                callbacks[callback.func_name] = callback
+        return callbacks
+
+    @staticmethod
+    def get_dispatch_table(cls) -> typing.Dict[str, typing.Tuple["HeosEventCallback", ...]]:
+        table = dict()
+        for callback in HeosEventCallback.get_callbacks(cls).values():
+            table[callback.name] = table.get(callback.name, tuple()) + (callback,)
+        return table
+
+
+class HeosVolumeController:
+    def __init__(self, device: "HeosDevice"):
+        self.device = device
+        self.target: typing.Optional[int] = None
+        self._task: typing.Optional[asyncio.Future] = None
 
-class HeosDevice:
+    async def set(self, volume: int) -> typing.Tuple[bool, int]:
+        self.target = min(max(int(volume), 0), 100)
+
+        # one set_volume at a time, bursts only move the target of the running one
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._settle())
+
+        return await asyncio.shield(self._task)
+
+    async def step(self, delta: int) -> typing.Tuple[bool, int]:
+        return await self.set((self.device.volume if self.target is None else self.target) + delta)
+
+    async def _settle(self) -> typing.Tuple[bool, int]:
+        try:
+            while True:
+                target = self.target
+                successful = await self.device.set_volume(target)
+                if not successful or self.target == target:
+                    return successful, self.device.volume
+        finally:
+            self.target = None
+
+
+class HeosDevice(heos.snapshot.HeosSnapshot):
+    snapshot_group = "devices"
+    _volume_control: typing.Optional[HeosVolumeController] = None
+    _fields = ('pid', 'name', 'model', 'version', 'ip', 'network', 'serial',
+               'play_state', 'volume', 'is_muted', 'repeat', 'now_playing')
 
     def __init__(self, data: dict, doUpdate=True):
         self.pid = int(data["pid"])
@@ -37,23 +105,60 @@ class HeosDevice:
         self.is_muted = False
         self.repeat = "off"
         self.now_playing = dict()
+        self._refresh_task: typing.Optional[asyncio.Future] = None
 
         if doUpdate:
             loop = asyncio.get_event_loop()
             loop.create_task(self.initialize())
 
     async def initialize(self):
-        await self.update_status()
-        await self.update_volume_force()
-        await self.update_now_playing()
+        await self.refresh_state()
+
+    async def refresh_state(self):
+        # concurrent callers share the refresh which is already running
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._refresh_state())
+
+        await asyncio.shield(self._refresh_task)
+
+    async def _refresh_state(self):
+        pid = str(self.pid).encode()
+        play_state, volume, mute, now_playing, play_mode = await asyncio.gather(
+            self._send_telnet_message(b'heos://player/get_play_state?pid=' + pid),
+            self._send_telnet_message(b'heos://player/get_volume?pid=' + pid),
+            self._send_telnet_message(b'heos://player/get_mute?pid=' + pid),
+            self._send_telnet_message(b'heos://player/get_now_playing_media?pid=' + pid),
+            self._send_telnet_message(b'heos://player/get_play_mode?pid=' + pid),
+        )
 
-    async def _send_telnet_message(self, command: bytes) -> (bool, str, dict):
+        if play_state[0]:
+            self.play_state = play_state[1].get("state", self.play_state)
+        if volume[0]:
+            self.volume = volume[1].get_int("level", self.volume)
+        if mute[0]:
+            self.is_muted = mute[1].get_bool("state", self.is_muted)
+        if now_playing[0]:
+            self.now_playing = now_playing[2]
+        if play_mode[0]:
+            self.repeat = play_mode[1].get("repeat", self.repeat)
+
+    def to_dict(self, fields: typing.Collection[str] = None) -> dict:
+        return {name: getattr(self, name) for name in self._fields if not fields or name in fields}
+
+    @property
+    def volume_control(self) -> HeosVolumeController:
+        if self._volume_control is None:
+            self._volume_control = HeosVolumeController(self)
+        return self._volume_control
+
+    async def _send_telnet_message(self, command: bytes) -> (bool, heos.protocol.HeosMessage, dict):
         data = await HeosDeviceManager.send_telnet_message(self.ip, command)
         successful = data["heos"]["result"] == 'success'
+        message = heos.protocol.HeosMessage.parse(data["heos"].get("message", ""))
         if "payload" in data:
-            return successful, data["heos"]["message"], data["payload"]
+            return successful, message, data["payload"]
         else:
-            return successful, data["heos"]["message"], {}
+            return successful, message, {}
 
     async def _ping(self):
         successful, _, _ = await self._send_telnet_message(b'heos://system/heart_beat')
@@ -111,18 +216,18 @@ class HeosDevice:
         successful, message, payload = await self._send_telnet_message(
             b'heos://player/get_play_state?pid=' + str(self.pid).encode())
         if successful:
-            self.play_state = re.search("(?<=&state=)[a-z]+", message).group(0)
+            self.play_state = message.get("state", self.play_state)
 
     async def update_volume_force(self):
         successful, message, payload = await self._send_telnet_message(
             b'heos://player/get_volume?pid=' + str(self.pid).encode())
         if successful:
-            self.volume = int(re.search("(?<=&level=)[0-9]+", message).group(0))
+            self.volume = message.get_int("level", self.volume)
 
         successful, message, payload = await self._send_telnet_message(
             b'heos://player/get_mute?pid=' + str(self.pid).encode())
         if successful:
-            self.is_muted = re.search("(?<=&state=)[a-z]+", message).group(0) == "on"
+            self.is_muted = message.get_bool("state", self.is_muted)
 
     @HeosEventCallback('player_volume_changed', ['level', 'mute'])
     async def update_volume(self, level, mute):
@@ -140,68 +245,156 @@ class HeosDevice:
     async def update_now_playing_progress(self, cur_pos, duration):
         self.now_playing["cur_pos"] = cur_pos
         self.now_playing["duration"] = duration
+        self.mark_dirty()
 
     async def update_repeat_mode_force(self):
         successful, message, payload = await self._send_telnet_message(
             b'heos://player//get_play_mode?pid=' + str(self.pid).encode())
         if successful:
-            self.repeat = re.search("(?<=&repeat=)[a-z_]+", message).group(0)
+            self.repeat = message.get("repeat", self.repeat)
 
     @HeosEventCallback('repeat_mode_changed', ['repeat', ])
     async def update_repeat_mode(self, repeat):
         self.repeat = repeat
 
 
+class HeosEventStats:
+    def __init__(self):
+        self.count = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def add(self, latency: float):
+        self.count += 1
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+
+    def to_dict(self) -> dict:
+        return {
+            "events": self.count,
+            "last_latency_ms": self.last_latency * 1000,
+            "max_latency_ms": self.max_latency * 1000,
+            "mean_latency_ms": self.total_latency / self.count * 1000 if self.count else 0.0,
+        }
+
+
 class HeosDeviceManager:
-    _locks: typing.Dict[str, asyncio.Lock] = dict()
+    connection_pool = heos.connection.HeosConnectionPool()
+    _event_dispatch_table = HeosEventCallback.get_dispatch_table(HeosDevice)
+    _system_event_dispatch_table = dict()  # type: typing.Dict[str, typing.Tuple[HeosEventCallback, ...]]
 
-    def __init__(self):
-        self._all_devices: typing.Dict[str, HeosDevice] = dict()
+    def __init__(self, scheduler: heos.scheduler.HeosScheduler = None):
+        self._all_devices: typing.Dict[int, HeosDevice] = dict()
         self._all_sources: typing.Dict[int, heos.sources.HeosSource] = dict()
+        self._devices_by_name: typing.Dict[str, HeosDevice] = dict()
+        self._sources_by_sid: typing.Dict[int, heos.sources.HeosSource] = dict()
+        self._indexed_nested_sources = -1
+        self._device_list: typing.List[HeosDevice] = list()
+        self._source_list: typing.List[heos.sources.HeosSource] = list()
+        self._ips: typing.List[str] = list()
         self.watch_enabled = False
-        self.event_telnet_connection: telnetlib.Telnet
-
-    async def initialize(self, list_of_ips):
-        await self._scan_for_devices(list_of_ips)
-        await self._scan_for_sources(list_of_ips)
-
-    @staticmethod
-    async def send_telnet_message(ip, command: bytes) -> dict:
-        if ip not in HeosDeviceManager._locks:
-            HeosDeviceManager._locks[ip] = asyncio.Lock()
+        self.event_subscription = heos.subscription.HeosEventSubscription(self)
+        self.scheduler = scheduler or heos.scheduler.HeosScheduler()
+        self.event_stats = HeosEventStats()
+        self._system_jobs: typing.Dict[typing.Tuple[str, tuple], None] = dict()
+        self._system_task: typing.Optional[asyncio.Future] = None
+
+    async def initialize(self, list_of_ips, concurrent: bool = True):
+        self._ips = list(dict.fromkeys(self._ips + list(list_of_ips)))
+        if concurrent:
+            await asyncio.gather(self._scan_for_devices_concurrent(list_of_ips),
+                                 self._scan_for_sources_concurrent(list_of_ips))
+        else:
+            await self._scan_for_devices(list_of_ips)
+            await self._scan_for_sources(list_of_ips)
 
-        async with HeosDeviceManager._locks[ip]:
-            tn = telnetlib.Telnet(ip, 1255)
-            tn.write(command + b"\n")
+        self._forget_moved_ips(list_of_ips)
 
-            message = b''
-            while True:
-                message += tn.read_until(b"}")
-                if message:
-                    try:
-                        data = json.loads(message.decode('utf-8'))
+    def _forget_moved_ips(self, list_of_ips):
+        # speakers which got a new address, e.g. from dhcp after a restart, leave their old one behind
+        device_ips = set(device.ip for device in self._device_list)
+        self._ips = [ip for ip in self._ips if ip in device_ips or ip in list_of_ips]
+        if not self._ips:
+            return
 
-                        # reset message because real answer was not fetched
-                        if data["heos"]["message"].startswith("command under process"):
-                            message = b''
-                        else:
-                            return data
+        moved = [source for source in self._all_sources.values() if source._ip not in self._ips]
+        for source in moved:
+            source.move_to(self._ips[0])
+        if moved:
+            self._reindex_sources()
 
-                    except json.JSONDecodeError:
-                        pass
+    @staticmethod
+    def _update_device(device: HeosDevice, data: dict):
+        # renamed or moved speakers keep their object, only the indexes change
+        device.name = data["name"]
+        device.ip = data["ip"]
+        device.version = data["version"]
+        device.network = data["network"]
 
-                    except UnicodeDecodeError:
-                        pass
+    @staticmethod
+    async def send_telnet_message(ip, command: bytes) -> dict:
+        return await HeosDeviceManager.connection_pool.request(ip, command)
 
     async def _scan_for_devices(self, list_of_ips):
         for ip in list_of_ips:
             data = await self.send_telnet_message(ip, b'heos://player/get_players')
             for device in data["payload"]:
                 if not device["pid"] in self._all_devices:
-                    new_device = HeosDevice(device)
-                    self._all_devices[new_device.pid] = new_device
+                    new_device = HeosDevice(device, doUpdate=False)
+                    self.add_device(new_device)
                     await new_device.initialize()
 
+    async def _get_players(self, list_of_ips) -> list:
+        # every speaker answers with the player list of the whole system, the first answer is enough
+        error = None
+        for ip in list_of_ips:
+            try:
+                data = await HeosDeviceManager.send_telnet_message(ip, b'heos://player/get_players')
+            except (asyncio.TimeoutError, OSError, EOFError) as e:
+                error = e
+                continue
+
+            # a system always has the answering speaker in it, an empty list is an error just like a failed reply
+            if data["heos"]["result"] == 'success' and data.get("payload"):
+                return data["payload"]
+            error = heos.protocol.HeosProtocolError(f"get_players failed on {ip}: {data['heos'].get('message', '')}")
+
+        if error:
+            raise error
+        return list()
+
+    async def _scan_for_devices_concurrent(self, list_of_ips):
+        new_devices = list()
+        for device in await self._get_players(list_of_ips):
+            known_device = self._all_devices.get(int(device["pid"]))
+            if known_device:
+                self._update_device(known_device, device)
+            else:
+                new_device = HeosDevice(device, doUpdate=False)
+                self.add_device(new_device)
+                new_devices.append(new_device)
+
+        self._reindex_devices()
+        await self._initialize_all([(device.ip, device) for device in new_devices])
+
+    async def _initialize_all(self, nodes: typing.List[typing.Tuple[str, typing.Any]]):
+        # one speaker which does not answer must not keep the others from being set up
+        results = await self.scheduler.gather(((ip, node.initialize) for ip, node in nodes), return_exceptions=True)
+        for (_, node), result in zip(nodes, results):
+            if isinstance(result, Exception):
+                logger.warning("could not initialize HEOS %s %s: %r", type(node).__name__, node.name, result)
+
+    async def _get_music_sources(self, ip: str) -> typing.Optional[list]:
+        try:
+            data = await HeosDeviceManager.send_telnet_message(ip, b'heos://browse/get_music_sources')
+        except (asyncio.TimeoutError, OSError, EOFError) as e:
+            logger.warning("could not get the HEOS music sources of %s: %r", ip, e)
+            return None
+
+        return data.get("payload") if data["heos"]["result"] == 'success' else None
+
     async def _scan_for_sources(self, list_of_ips):
         for ip in list_of_ips:
             data = await self.send_telnet_message(ip, b'heos://browse/get_music_sources')
@@ -211,127 +404,293 @@ class HeosDeviceManager:
                     self._all_sources[new_source.sid] = new_source
                     await new_source.initialize()
 
-    async def _filter_response_for_event(self) -> dict:
-        tn = self.event_telnet_connection
-        message = b''
-        while True:
-            message += tn.read_until(b'}', 0.1)
-            if message:
-                try:
-                    data = json.loads(message.decode('utf-8'))
-                    return data
-                except json.JSONDecodeError:
-                    pass
-                except UnicodeDecodeError:
-                    pass
-            await asyncio.sleep(0.1)
+        self._reindex_sources()
 
-    async def start_watch_events(self):
-        if not self._all_devices or self.watch_enabled:
+    async def _scan_for_sources_concurrent(self, list_of_ips):
+        responses = await self.scheduler.gather(
+            (ip, functools.partial(self._get_music_sources, ip)) for ip in list_of_ips)
+
+        # keep the order of the serial scan, the first ip providing a source owns it
+        new_sources = list()
+        for ip, payload in zip(list_of_ips, responses):
+            for source in payload or ():
+                if not source["sid"] in self._all_sources:
+                    new_source = heos.sources.HeosSource(ip, None, source)
+                    self._all_sources[new_source.sid] = new_source
+                    new_sources.append(new_source)
+
+        await self._initialize_all([(source._ip, source) for source in new_sources])
+        self._reindex_sources()
+
+    def replace_ip(self, old_ip: str, new_ip: str):
+        self._ips = list(dict.fromkeys(new_ip if ip == old_ip else ip for ip in self._ips))
+
+    async def forget_ips(self, list_of_ips):
+        self._ips = [ip for ip in self._ips if ip not in list_of_ips]
+        # the remaining speakers know whether the lost ones are really gone
+        if self._ips:
+            await self.update_players()
+
+    @HeosEventCallback('players_changed', background=True)
+    async def update_players(self):
+        players = await self._get_players(self._ips or [device.ip for device in self._device_list])
+
+        new_devices = list()
+        for data in players:
+            device = self._all_devices.get(int(data["pid"]))
+            if device:
+                self._update_device(device, data)
+            else:
+                device = HeosDevice(data, doUpdate=False)
+                new_devices.append(device)
+                self._all_devices[device.pid] = device
+
+        pids = set(int(data["pid"]) for data in players)
+        for pid in [pid for pid in self._all_devices if pid not in pids]:
+            self._all_devices.pop(pid)
+
+        self._reindex_devices()
+        self._forget_moved_ips(())
+        await self._initialize_all([(device.ip, device) for device in new_devices])
+
+    @HeosEventCallback('source_data_changed', ['sid'])
+    async def invalidate_source(self, sid):
+        if sid.lstrip('-').isdigit():
+            heos.sources.HeosSourceBase.browse_cache.invalidate(int(sid))
+
+    @HeosEventCallback('sources_changed', background=True)
+    async def update_sources(self):
+        heos.sources.HeosSourceBase.browse_cache.invalidate()
+        ips = self._ips or list(dict.fromkeys(device.ip for device in self._device_list))
+        for ip in ips:
+            try:
+                data = await HeosDeviceManager.send_telnet_message(ip, b'heos://browse/get_music_sources')
+            except (asyncio.TimeoutError, OSError, EOFError):
+                continue
+
+            if data["heos"]["result"] == 'success':
+                break
+        else:
             return
 
-        self.watch_enabled = True
+        available = {source["sid"]: source.get("available", "") for source in data["payload"]}
+        for sid in [sid for sid in self._all_sources if sid not in available]:
+            self._all_sources.pop(sid)
+        for sid, source in self._all_sources.items():
+            source.available = available[sid]
+
+        await self._scan_for_sources_concurrent([ip])
+
+    def export_system(self) -> dict:
+        return {
+            "ips": self._ips,
+            "devices": [device.to_dict() for device in self._device_list],
+            "sources": [{"ip": source._ip, "tree": source.export()} for source in self._source_list],
+        }
+
+    def import_system(self, data: dict):
+        self._ips = list(data["ips"])
+
+        for device_data in data["devices"]:
+            device = HeosDevice(device_data, doUpdate=False)
+            device.play_state = device_data["play_state"]
+            device.volume = device_data["volume"]
+            device.is_muted = device_data["is_muted"]
+            device.repeat = device_data["repeat"]
+            device.now_playing = device_data["now_playing"]
+            self._all_devices[device.pid] = device
+
+        for source_data in data["sources"]:
+            source = heos.sources.HeosSourceBase.from_export(source_data["ip"], None, source_data["tree"])
+            self._all_sources[source.sid] = source
+
+        self._reindex_devices()
+        self._reindex_sources()
+
+    async def save(self, store: heos.store.HeosStateStore):
+        await store.save(self.export_system())
+
+    async def restore(self, store: heos.store.HeosStateStore) -> bool:
+        data = await store.load()
+        if not data:
+            return False
 
-        ip = self.get_all_devices()[0].ip
-        self.event_telnet_connection = telnetlib.Telnet(ip, 1255)
-        command = b'heos://system/register_for_change_events?enable=on'
-        self.event_telnet_connection.write(command + b"\n")
-        await self._filter_response_for_event()
+        try:
+            self.import_system(data)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            # a damaged snapshot is no worse than none, the system is scanned from scratch
+            self._all_devices.clear()
+            self._all_sources.clear()
+            self._reindex_devices()
+            self._reindex_sources()
+            return False
 
-        loop = asyncio.get_event_loop()
-        loop.create_task(self._watch_events())
+        return True
 
-    async def stop_watch_events(self):
-        self.watch_enabled = False
+    async def revalidate(self):
+        # a restored system may be outdated, everything known is asked for again
+        await self.update_players()
+        await self.resync_devices()
+        # events are received while the sources are browsed again, which takes long for big libraries
+        await self.start_watch_events()
+        await self.update_sources()
+        await self.scheduler.gather((source._ip, source.initialize) for source in self._source_list)
+        self._reindex_sources()
+
+    async def start_watch_events(self):
+        if not self._all_devices or self.watch_enabled:
+            return
 
-    async def _watch_events(self):
-        heos_functions = self.get_heos_decorators()
+        self.watch_enabled = await self.event_subscription.start()
 
-        while self.watch_enabled:
-            response = await self._filter_response_for_event()
-            command = response["heos"]["command"]  # type:str
-            if command.startswith("event/"):
-                event = command[6:]
-                message = ""
-                if "message" in response["heos"]:
-                    message = response["heos"]["message"]
+    async def stop_watch_events(self):
+        self.watch_enabled = False
+        self.event_subscription.stop()
 
-                heos.EventQueueManager.add_event(heos.ServerHeosEvent({
-                    "command": command,
-                    "event": event,
-                    "message": message,
-                    "full": response
-                }))
+    async def resync_devices(self) -> int:
+        def get_state(device: HeosDevice) -> tuple:
+            return device.play_state, device.volume, device.is_muted, device.repeat, device.now_playing
 
-                for name, func in heos_functions.items():
-                    if func[0]["event"] == event:
-                        pid = int(re.search("(?<=pid=)-?[a-z0-9]+", message).group(0))
-                        if pid and pid in self._all_devices:
+        devices = self.get_all_devices()
+        before = [get_state(device) for device in devices]
+        await self.scheduler.gather((device.ip, device.refresh_state) for device in devices)
 
-                            param_list = list()
-                            for param in func[0]["params"]:
-                                value = re.search("(?<=" + param + "=)[a-z0-9_]+", message).group(0)
-                                param_list.append(value)
+        # every changed field stands for at least one event which got lost
+        return sum(
+            sum(1 for old, new in zip(old_state, get_state(device)) if old != new)
+            for old_state, device in zip(before, devices))
 
-                            func = getattr(self._all_devices[int(pid)], name)
-                            await func(*param_list)
+    async def _handle_event(self, response: dict) -> bool:
+        command = response["heos"]["command"]  # type:str
+        if not command.startswith("event/"):
+            # e.g. the answer to a heart beat, which is no event
+            return False
 
-            await asyncio.sleep(0.1)
+        event = command[6:]
+        message = ""
+        if "message" in response["heos"]:
+            message = response["heos"]["message"]
+
+        heos.EventQueueManager.add_event(heos.ServerHeosEvent({
+            "command": command,
+            "event": event,
+            "message": message,
+            "full": response
+        }))
+
+        parsed_message = heos.protocol.HeosMessage.parse(message)
+        for callback in self._system_event_dispatch_table.get(event, ()):
+            params = callback.get_params(parsed_message)
+            if params is None:
+                continue
+
+            if callback.background:
+                self._schedule_system_job(callback.func_name, tuple(params))
+            else:
+                await getattr(self, callback.func_name)(*params)
+
+        callbacks = self._event_dispatch_table.get(event)
+        if not callbacks:
+            return True
+
+        pid = parsed_message.get_int("pid", 0)
+        if not pid or pid not in self._all_devices:
+            return True
+
+        device = self._all_devices[pid]
+        for callback in callbacks:
+            params = callback.get_params(parsed_message)
+            if params is not None:
+                await getattr(device, callback.func_name)(*params)
+
+        return True
+
+    def _schedule_system_job(self, func_name: str, params: tuple):
+        # a job which is waiting already covers this event too, so a burst of events runs it only once more
+        self._system_jobs[(func_name, params)] = None
+        if self._system_task is None or self._system_task.done():
+            self._system_task = asyncio.ensure_future(self._run_system_jobs())
+
+    async def _run_system_jobs(self):
+        # one job at a time, e.g. update_players and update_sources must not scan the system concurrently
+        while self._system_jobs:
+            func_name, params = next(iter(self._system_jobs))
+            del self._system_jobs[(func_name, params)]
+            try:
+                await getattr(self, func_name)(*params)
+            except Exception:
+                logger.exception("HEOS system event handler %s failed", func_name)
+
+    async def wait_for_system_jobs(self):
+        while self._system_task is not None and not self._system_task.done():
+            await asyncio.shield(self._system_task)
 
     @staticmethod
     def get_heos_decorators(cls=HeosDevice):
-        target = cls
-        decorators = {}
-
-        def visit_FunctionDef(node):
-            decorators[node.name] = []
-            for n in node.decorator_list:
-                name = ''
-                if isinstance(n, ast.Call):
-                    name = n.func.attr if isinstance(n.func, ast.Attribute) else n.func.id
-                if name in ('HeosEventCallback',):
-                    params = list()
-                    if len(n.args) == 2:
-                        for val in n.args[1].elts:
-                            params.append(val.value)
-
-                    decorators[node.name].append({
-                        "name": name,
-                        "event": n.args[0].value,
-                        "params": params
-                    })
-
-            if not decorators[node.name]:
-                decorators.pop(node.name)
-
-        node_iter = ast.NodeVisitor()
-        node_iter.visit_AsyncFunctionDef = visit_FunctionDef
-        node_iter.visit(ast.parse(inspect.getsource(target)))
+        decorators = dict()
+        for name, callback in HeosEventCallback.get_callbacks(cls).items():
+            decorators[name] = [{
+                "name": "HeosEventCallback",
+                "event": callback.name,
+                "params": list(callback.param_names)
+            }]
 
         return decorators
 
-    def get_all_devices(self) -> typing.List[HeosDevice]:
-        if not self._all_devices:
-            return list()
+    def add_device(self, device: HeosDevice):
+        self._all_devices[device.pid] = device
+        self._reindex_devices()
+
+    def remove_device(self, pid: int) -> typing.Optional[HeosDevice]:
+        device = self._all_devices.pop(pid, None)
+        self._reindex_devices()
+        return device
+
+    def _reindex_devices(self):
+        self._devices_by_name = {device.name: device for device in self._all_devices.values()}
+        self._device_list = list(self._all_devices.values())
+        heos.snapshot.HeosSnapshot.touch(HeosDevice.snapshot_group)
+
+    def _reindex_sources(self):
+        def walk(source: heos.sources.HeosSourceBase):
+            if isinstance(source, heos.sources.HeosSource) and source.sid not in index:
+                index[source.sid] = source
+            for child in source.get_children():
+                walk(child)
 
-        return list(self._all_devices.values())
+        self._indexed_nested_sources = heos.sources.HeosSourceBase.nested_sources
+        index = dict()  # type: typing.Dict[int, heos.sources.HeosSource]
+        for source in self._all_sources.values():
+            walk(source)
+
+        self._sources_by_sid = index
+        self._source_list = list(self._all_sources.values())
+        heos.snapshot.HeosSnapshot.touch(heos.sources.HeosSourceBase.snapshot_group)
+
+    def get_all_devices(self) -> typing.List[HeosDevice]:
+        return self._device_list
 
     def get_device_by_name(self, name) -> HeosDevice:
-        for device in self._all_devices.values():  # type: HeosDevice
-            if device.name == name:
-                return device
+        return self._devices_by_name.get(name)
 
-    def get_all_sources(self) -> list:
-        if not self._all_sources:
-            return list()
+    def get_device_by_pid(self, pid: int) -> HeosDevice:
+        return self._all_devices.get(pid)
 
-        return list(self._all_sources.values())
+    def get_all_sources(self) -> list:
+        return self._source_list
 
-    def get_source_by_id(self, sid: int) -> list:
-        if not self._all_sources:
+    def get_source_by_id(self, sid: int) -> "heos.sources.HeosSource":
+        try:
+            sid = int(sid)
+        except (TypeError, ValueError):
             return None
 
-        for container in self._all_sources.values():  # type: heos.source.HeosSource
-            found = container.get_source(sid)
-            if found:
-                return found
+        nested_sources = heos.sources.HeosSourceBase.nested_sources
+        if sid not in self._sources_by_sid and self._indexed_nested_sources != nested_sources:
+            # a browse put new sources below others since the last index, pick them up on demand
+            self._reindex_sources()
+
+        return self._sources_by_sid.get(sid)
+
+
+HeosDeviceManager._system_event_dispatch_table = HeosEventCallback.get_dispatch_table(HeosDeviceManager)
@@ -0,0 +1,102 @@
+import functools
+import json
+import typing
+import urllib.parse
+
+FRAME_DELIMITER = b"\r\n"
+
+
+class HeosProtocolError(Exception):
+    pass
+
+
+class HeosFrameDecoder:
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scan_from = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def feed(self, data: bytes) -> typing.List[dict]:
+        self._buffer += data
+
+        frames = list()
+        start = 0
+        while True:
+            end = self._buffer.find(FRAME_DELIMITER, max(self._scan_from, start))
+            if end < 0:
+                break
+
+            frame = bytes(self._buffer[start:end])
+            start = end + len(FRAME_DELIMITER)
+            if frame.strip():
+                frames.append(frame)
+
+        del self._buffer[:start]
+        # a delimiter split across two reads starts in the last byte of the buffer
+        self._scan_from = max(len(self._buffer) - len(FRAME_DELIMITER) + 1, 0)
+
+        return [self.decode(frame) for frame in frames]
+
+    @staticmethod
+    def decode(frame: bytes) -> dict:
+        try:
+            return json.loads(frame.decode('utf-8'))
+        except UnicodeDecodeError as e:
+            raise HeosProtocolError(f"invalid utf-8 in HEOS frame: {frame[:80]!r}") from e
+        except json.JSONDecodeError as e:
+            raise HeosProtocolError(f"invalid json in HEOS frame: {frame[:80]!r}") from e
+
+
+class HeosMessage:
+    def __init__(self, raw: str):
+        self.raw = raw
+        self._fields: typing.Optional[typing.Dict[str, str]] = None
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def parse(raw: str) -> "HeosMessage":
+        return HeosMessage(raw)
+
+    @property
+    def fields(self) -> typing.Dict[str, str]:
+        if self._fields is None:
+            self._fields = dict()
+            for part in self.raw.split("&"):
+                key, _, value = part.partition("=")
+                if key:
+                    self._fields[key] = urllib.parse.unquote(value) if "%" in value else value
+        return self._fields
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.fields
+
+    def __str__(self) -> str:
+        return self.raw
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, HeosMessage):
+            return self.raw == other.raw
+        return self.raw == other
+
+    def __hash__(self) -> int:
+        return hash(self.raw)
+
+    def startswith(self, prefix: str) -> bool:
+        return self.raw.startswith(prefix)
+
+    def get(self, key: str, default: typing.Optional[str] = None) -> typing.Optional[str]:
+        return self.fields.get(key, default)
+
+    def get_int(self, key: str, default: typing.Optional[int] = None) -> typing.Optional[int]:
+        try:
+            return int(self.fields[key])
+        except (KeyError, ValueError):
+            return default
+
+    def get_bool(self, key: str, default: typing.Optional[bool] = None) -> typing.Optional[bool]:
+        if key not in self.fields:
+            return default
+        return self.fields[key] in ("on", "yes", "true")
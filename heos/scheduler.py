@@ -0,0 +1,29 @@
+import asyncio
+import typing
+
+
+class HeosScheduler:
+    def __init__(self, max_concurrency: int = 16, max_concurrency_per_ip: int = 4):
+        self.max_concurrency = max_concurrency
+        self.max_concurrency_per_ip = max_concurrency_per_ip
+
+        self._semaphore: typing.Optional[asyncio.Semaphore] = None
+        self._ip_semaphores: typing.Dict[str, asyncio.Semaphore] = dict()
+
+    def _get_semaphores(self, ip: str) -> typing.Tuple[asyncio.Semaphore, asyncio.Semaphore]:
+        # created lazily, so they belong to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if ip not in self._ip_semaphores:
+            self._ip_semaphores[ip] = asyncio.Semaphore(self.max_concurrency_per_ip)
+        return self._semaphore, self._ip_semaphores[ip]
+
+    async def run(self, ip: str, func: typing.Callable[..., typing.Awaitable], *args):
+        global_slots, ip_slots = self._get_semaphores(ip)
+        async with global_slots:
+            async with ip_slots:
+                return await func(*args)
+
+    async def gather(self, jobs: typing.Iterable[typing.Tuple[str, typing.Callable[..., typing.Awaitable]]],
+                     return_exceptions: bool = False) -> list:
+        return await asyncio.gather(*(self.run(ip, func) for ip, func in jobs), return_exceptions=return_exceptions)
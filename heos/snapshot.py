@@ -0,0 +1,75 @@
+import hashlib
+import typing
+
+
+class HeosSnapshot:
+    __slots__ = ()
+
+    # one version per group of objects, bumped by every change in the group,
+    # a cached response is valid as long as the version of its group did not move
+    versions: typing.Dict[str, int] = dict()
+    snapshot_group = ""
+    _snapshot = None
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # a slotted object has no snapshot slot set while it is built, there is nothing to invalidate yet
+        if not name.startswith("_") and getattr(self, "_snapshot", False) is not False:
+            self.mark_dirty()
+
+    def _get_snapshot_parent(self) -> typing.Optional["HeosSnapshot"]:
+        return None
+
+    def mark_dirty(self):
+        # the snapshot of a parent contains the one of its children, so the whole path up gets dirty
+        node = self
+        while node is not None:
+            object.__setattr__(node, "_snapshot", None)
+            node = node._get_snapshot_parent()
+
+        HeosSnapshot.touch(self.snapshot_group)
+
+    def get_snapshot(self, key: str, encode: typing.Callable[[typing.Any], bytes]) -> bytes:
+        # one snapshot per requested variant, e.g. a field selection
+        snapshots = getattr(self, "_snapshot", None)
+        if snapshots is None or len(snapshots) >= 8 and key not in snapshots:
+            snapshots = dict()
+            object.__setattr__(self, "_snapshot", snapshots)
+
+        if key not in snapshots:
+            snapshots[key] = encode(self)
+        return snapshots[key]
+
+    @staticmethod
+    def touch(group: str):
+        HeosSnapshot.versions[group] = HeosSnapshot.versions.get(group, 0) + 1
+
+
+class HeosSnapshotCache:
+    max_responses = 32
+
+    def __init__(self):
+        self._responses: typing.Dict[str, typing.Tuple[int, bytes, str]] = dict()
+
+    def get(self, key: str, group: str, objects: typing.Iterable[HeosSnapshot],
+            encode: typing.Callable[[typing.Any], bytes]) -> typing.Tuple[bytes, str]:
+        version = HeosSnapshot.versions.get(group, 0)
+        cached = self._responses.get(key)
+        if cached and cached[0] == version:
+            return cached[1], cached[2]
+
+        # only dirty objects are encoded again, the others are joined from their cached bytes
+        body = b"[" + b", ".join(item.get_snapshot(key, encode) for item in objects) + b"]"
+        etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        if len(self._responses) >= self.max_responses and key not in self._responses:
+            self._responses.clear()
+        self._responses[key] = (version, body, etag)
+        return body, etag
+
+    @staticmethod
+    def matches(if_none_match: typing.Optional[str], etag: str) -> bool:
+        if not if_none_match:
+            return False
+
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or "W/" + etag in tags
@@ -1,9 +1,17 @@
+import asyncio
+import sys
 import typing
 
+import heos.cache
 import heos.manager
+import heos.protocol
+import heos.scheduler
+import heos.snapshot
 
 
 class HeosSearchCriteria:
+    __slots__ = ('_ip', '_parent', 'scid', 'name', 'allow_wildcard', 'is_playable', 'cid')
+    _fields = ('scid', 'name', 'allow_wildcard', 'is_playable', 'cid')
 
     def __init__(self, ip, parent, data):
         self._ip = ip
@@ -14,29 +22,127 @@ class HeosSearchCriteria:
         self.is_playable = data["playable"] == "yes" if "playable" in data else False
         self.cid = data["cid"] if "cid" in data else 0
 
+    def to_dict(self, fields: typing.Collection[str] = None) -> dict:
+        return {name: getattr(self, name) for name in self._fields if not fields or name in fields}
+
+    def get_data(self) -> dict:
+        return {
+            "scid": self.scid,
+            "name": self.name,
+            "wildcard": "yes" if self.allow_wildcard else "no",
+            "playable": "yes" if self.is_playable else "no",
+            "cid": self.cid,
+        }
+
+
+class HeosSourceBase(heos.snapshot.HeosSnapshot):
+    # large libraries create many thousand nodes, so no __dict__ and no empty containers per node
+    __slots__ = ('_ip', '_parent', '_id', '_snapshot', '_children', '_search_criteria', 'type', 'name')
+    _fields = ('type', 'name')
+    snapshot_group = "sources"
+    # the cli answers at most 100 items per browse request
+    page_size = 100
+    browse_cache = heos.cache.HeosBrowseCache()
+    # browse requests running at once while a tree is walked with browse_tree
+    browse_concurrency = 8
+    # bumped whenever a browse puts a source below another one, the manager indexes them again then
+    nested_sources = 0
 
-class HeosSourceBase:
     def __init__(self, ip, parent, data):
         self._ip = ip
         self._parent: HeosSourceBase = parent
         self._id = self._get_id_tuple(data)[1]
+        self._children: typing.Optional[typing.Dict[str, HeosSourceBase]] = None
+        self._search_criteria: typing.Optional[typing.List[HeosSearchCriteria]] = None
 
-        self.type = data["type"]
+        self.type = sys.intern(data["type"])
         self.name = data["name"]
-
-        self.children: typing.Dict[str, HeosSourceBase] = dict()
-        self.search_criteria: typing.List[HeosSearchCriteria] = list()
+        # subclasses set _snapshot at the end of __init__, changes from then on invalidate cached snapshots
 
     async def initialize(self):
         raise NotImplementedError
 
-    async def _send_telnet_message(self, command: bytes) -> (bool, str, dict):
+    @property
+    def children(self) -> typing.Dict[str, "HeosSourceBase"]:
+        if self._children is None:
+            self._children = dict()
+        return self._children
+
+    @children.setter
+    def children(self, children: typing.Dict[str, "HeosSourceBase"]):
+        self._children = children
+
+    @property
+    def search_criteria(self) -> typing.List[HeosSearchCriteria]:
+        if self._search_criteria is None:
+            self._search_criteria = list()
+        return self._search_criteria
+
+    @search_criteria.setter
+    def search_criteria(self, search_criteria: typing.List[HeosSearchCriteria]):
+        self._search_criteria = search_criteria
+
+    def get_children(self) -> typing.Iterable["HeosSourceBase"]:
+        return self._children.values() if self._children else ()
+
+    def move_to(self, ip: str):
+        # every node asks the speaker of its source, so the whole tree follows a source to another speaker
+        nodes = [self]
+        while nodes:
+            node = nodes.pop()
+            node._ip = ip
+            for criteria in node._search_criteria or ():
+                criteria._ip = ip
+            nodes.extend(node.get_children())
+
+    def _get_snapshot_parent(self):
+        return self._parent
+
+    def to_dict(self, fields: typing.Collection[str] = None, depth: int = None) -> dict:
+        result = {name: getattr(self, name) for name in self._fields if not fields or name in fields}
+
+        if not fields or "search_criteria" in fields:
+            result["search_criteria"] = [criteria.to_dict() for criteria in self._search_criteria or ()]
+
+        # depth counts the levels of children, None returns the whole browsed tree
+        if (not fields or "children" in fields) and (depth is None or depth > 0):
+            child_depth = None if depth is None else depth - 1
+            result["children"] = {key: child.to_dict(fields, child_depth)
+                                  for key, child in (self._children or dict()).items()}
+
+        return result
+
+    def get_data(self) -> dict:
+        # the node as the cli describes it, the constructor builds the same node from it again
+        return {"type": self.type, "name": self.name}
+
+    def export(self) -> list:
+        return [self.get_data(),
+                [child.export() for child in self.get_children()],
+                [criteria.get_data() for criteria in self._search_criteria or ()]]
+
+    @staticmethod
+    def from_export(ip, parent, exported: list) -> "HeosSourceBase":
+        data, children, search_criteria = exported
+        node = HeosSourceBase._get_id_tuple(data)[0](ip, parent, data)  # type: HeosSourceBase
+
+        if children:
+            node.children = {child._id: child for child in (
+                HeosSourceBase.from_export(ip, node, child_export) for child_export in children)}
+        if search_criteria:
+            node.search_criteria = [
+                HeosSearchCriteria(ip, node._get_sid_from_parent(), criteria) for criteria in search_criteria]
+
+        return node
+
+    async def _send_telnet_message(self, command: bytes) -> (bool, heos.protocol.HeosMessage, dict):
         data = await heos.manager.HeosDeviceManager.send_telnet_message(self._ip, command)
         successful = data["heos"]["result"] == 'success'
+        message = heos.protocol.HeosMessage.parse(data["heos"].get("message", ""))
         if "payload" in data:
-            return successful, data["heos"]["message"], data["payload"]
+            return successful, message, data["payload"]
         else:
-            return successful, data["heos"]["message"], {}
+            return successful, message, {}
 
     @staticmethod
     def _get_id_tuple(json_data) -> (type, str):
@@ -67,36 +173,150 @@ class HeosSourceBase:
             return self._parent._get_sid_from_parent()
 
     def get_container(self, cid: str):
-        for child in self.children.values():
+        for child in self.get_children():
             found = child.get_container(cid)
             if found:
                 return found
 
-    async def browse(self, recursion_level=0):
-        successful, message, payload = await self._send_telnet_message(
-            self._get_browse_command())
+    async def browse_page(self, start: int, limit: int) \
+            -> typing.Tuple[bool, typing.List["HeosSourceBase"], typing.Optional[int]]:
+        # the range of the cli includes both ends
+        key = self._get_browse_location() + (start, start + limit - 1)
+        cached = HeosSourceBase.browse_cache.get(key)
+        if cached is None:
+            successful, message, payload = await self._send_telnet_message(self._get_browse_command(*key[2:]))
+            if not successful:
+                return False, list(), None
+
+            cached = payload, message.get_int("count")
+            HeosSourceBase.browse_cache.put(key, *cached)
+
+        payload, count = cached
+        children = [self._get_id_tuple(child)[0](self._ip, self, child) for child in payload]
+        return True, children, count
+
+    def _get_page_limit(self, start: int, end: typing.Optional[int]) -> int:
+        return self.page_size if end is None else min(self.page_size, end - start)
+
+    async def _browse_pages(self, offset: int = 0, limit: int = None) \
+            -> typing.AsyncIterator[typing.Tuple[bool, typing.List["HeosSourceBase"], typing.Optional[int]]]:
+        end = None if limit is None else offset + limit
+        requested = self._get_page_limit(offset, end)
+        page = asyncio.ensure_future(self.browse_page(offset, requested)) if requested > 0 else None
+        try:
+            while page is not None:
+                successful, children, count = await page
+                offset += len(children)
+
+                page = None
+                more = count is not None and offset < count or count is None and len(children) == requested
+                if successful and children and more and (end is None or offset < end):
+                    # the next page is on its way while the caller works on this one
+                    requested = self._get_page_limit(offset, end)
+                    page = asyncio.ensure_future(self.browse_page(offset, requested))
+
+                yield successful, children, count
+        finally:
+            if page is not None:
+                page.cancel()
+
+    async def iter_children(self, offset: int = 0, limit: int = None) -> typing.AsyncIterator["HeosSourceBase"]:
+        pages = self._browse_pages(offset, limit)
+        try:
+            async for successful, children, _ in pages:
+                for child in children:
+                    yield child
+        finally:
+            # a caller stopping early cancels the prefetched page
+            await pages.aclose()
+
+    async def browse_range(self, offset: int = 0, limit: int = None) \
+            -> typing.Tuple[typing.List["HeosSourceBase"], typing.Optional[int]]:
+        children, count = list(), None
+        async for successful, page, page_count in self._browse_pages(offset, limit):
+            if successful:
+                children.extend(page)
+                count = page_count
+
+        # merged into the tree, so a container of this page can be looked up and browsed later on,
+        # a child which is known already keeps its node and the subtree browsed below it
+        children = [self.children.setdefault(child._id, child) for child in children]
+        if children:
+            self._count_nested_sources(children)
+            self.mark_dirty()
+
+        return children, count
+
+    async def _browse_children(self) -> typing.List["HeosSourceBase"]:
+        children = None
+        async for successful, page, _ in self._browse_pages():
+            if not successful:
+                break
+
+            if children is None:
+                self.children = children = dict()
+
+            for new_child in page:
+                # keyed by the id string of the child itself, so the key costs no extra memory
+                children[new_child._id] = new_child
+
+        if children is None:
+            return list()
+
+        self._count_nested_sources(children.values())
+        self.mark_dirty()
+        return list(children.values())
 
-        if successful:
-            self.children = dict()
-            for child in payload:
-                child_type, child_id = self._get_id_tuple(child)
-                new_child = child_type(self._ip, self, child)  # type: HeosSourceBase
-                self.children[child_id] = new_child
+    @staticmethod
+    def _count_nested_sources(children: typing.Iterable["HeosSourceBase"]):
+        if any(isinstance(child, HeosSource) for child in children):
+            HeosSourceBase.nested_sources += 1
 
-                await new_child.initialize()
-                if recursion_level > 0:
-                    await new_child.browse(recursion_level - 1)
+    async def _browse_and_initialize_children(self) -> typing.List["HeosSourceBase"]:
+        children = await self._browse_children()
+        for child in children:
+            await child.initialize()
+        return children
 
-    def _get_browse_command(self):
+    async def browse(self, recursion_level=0):
+        for new_child in await self._browse_children():
+            await new_child.initialize()
+            if recursion_level > 0:
+                await new_child.browse(recursion_level - 1)
+
+    async def browse_tree(self, recursion_level=0):
+        # same tree as browse(), built level by level with the nodes of a level browsed concurrently
+        pool = heos.manager.HeosDeviceManager.connection_pool
+        scheduler = heos.scheduler.HeosScheduler(
+            self.browse_concurrency, min(self.browse_concurrency, pool.max_connections_per_ip * pool.max_in_flight))
+
+        level = [self]
+        for _ in range(recursion_level + 1):
+            results = await scheduler.gather((node._ip, node._browse_and_initialize_children) for node in level)
+            level = [child for children in results for child in children]
+
+    def _get_browse_location(self) -> typing.Tuple[int, str]:
         raise NotImplementedError
 
+    def _get_browse_command(self, start: int, end: int) -> bytes:
+        sid, cid = self._get_browse_location()
+        return b'heos://browse/browse?sid=' + str(sid).encode() \
+               + (b'&cid=' + cid.encode() if cid else b'') \
+               + b'&range=' + str(start).encode() + b',' + str(end).encode()
+
 
 class HeosSourceMusic(HeosSourceBase):
+    __slots__ = ('mid',)
+    _fields = HeosSourceBase._fields + ('mid',)
 
     def __init__(self, ip, parent, data):
         super().__init__(ip, parent, data)
 
         self.mid = data["mid"]
+        self._snapshot = None
+
+    def get_data(self):
+        return dict(super().get_data(), mid=self.mid)
 
     async def initialize(self):
         pass
@@ -104,14 +324,22 @@ class HeosSourceMusic(HeosSourceBase):
     def get_container(self, cid: str):
         pass
 
-    async def _get_browse_command(self):
+    def _get_browse_location(self):
         pass
 
+    async def browse_page(self, start: int, limit: int):
+        return True, list(), 0
+
+    async def _browse_children(self):
+        return list()
+
     async def browse(self, recursion_level=0):
         pass
 
 
 class HeosSourceContainer(HeosSourceBase):
+    __slots__ = ('cid', 'is_container', 'is_playable', '_sid')
+    _fields = HeosSourceBase._fields + ('cid', 'is_container', 'is_playable')
 
     def __init__(self, ip, parent, data):
         super().__init__(ip, parent, data)
@@ -120,6 +348,11 @@ class HeosSourceContainer(HeosSourceBase):
         self.is_playable = data["playable"] == "yes" if "playable" in data else False
 
         self._sid = self._get_sid_from_parent()
+        self._snapshot = None
+
+    def get_data(self):
+        return dict(super().get_data(), cid=self.cid, container="yes" if self.is_container else "no",
+                    playable="yes" if self.is_playable else "no")
 
     async def initialize(self):
         pass
@@ -130,17 +363,16 @@ class HeosSourceContainer(HeosSourceBase):
 
         return super().get_container(cid)
 
-    def _get_browse_command(self):
-        # TODO: get valid range
-        return b'heos://browse/browse?sid=' + str(self._sid).encode() \
-               + b'&cid=' + str(self.cid).encode() \
-               + b'&range=0,100'
+    def _get_browse_location(self):
+        return self._sid, str(self.cid)
 
     def _get_cid_from_parent(self):
         return self.cid
 
 
 class HeosSource(HeosSourceBase):
+    __slots__ = ('sid', 'available', 'username')
+    _fields = HeosSourceBase._fields + ('sid', 'available', 'username')
 
     def __init__(self, ip, parent, data):
         super().__init__(ip, parent, data)
@@ -148,13 +380,18 @@ class HeosSource(HeosSourceBase):
         self.sid = data["sid"] if "sid" in data else ""
         self.available = data["available"] if "available" in data else ""
         self.username = data["service_username"] if "service_username" in data else ""
+        self._snapshot = None
+
+    def get_data(self):
+        return dict(super().get_data(), sid=self.sid, available=self.available, service_username=self.username)
 
     async def initialize(self):
         await self.get_search_criteria()
         if self.sid > 1000:  # no online services
-            await self.browse(2)
+            await self.browse_tree(2)
 
     async def refresh(self):
+        HeosSourceBase.browse_cache.invalidate(self.sid)
         successful, message, payload = await self._send_telnet_message(
             b'heos://browse/get_source_info?sid=' + str(self.sid).encode())
 
@@ -173,14 +410,14 @@ class HeosSource(HeosSourceBase):
             for criteria in payload:
                 self.search_criteria.append(HeosSearchCriteria(self._ip, self.sid, criteria))
 
-    def _get_browse_command(self):
-        return b'heos://browse/browse?sid=' + str(self.sid).encode()
+    def _get_browse_location(self):
+        return self.sid, ""
 
     def get_source(self, sid: int):
         if int(sid) == self.sid:
             return self
 
-        for (child_type, child) in self.children.items():  # type:(str, HeosSourceBase)
+        for (child_type, child) in (self._children or dict()).items():  # type:(str, HeosSourceBase)
             if child_type[0:3] == "sid":
                 return child.get_source(sid)
 
@@ -0,0 +1,50 @@
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import typing
+import zlib
+
+
+class HeosStateStore:
+    # bumped whenever the layout of the stored system changes, older files are ignored then
+    version = 1
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _write(self, data: dict):
+        encoded = json.dumps(dict(data, version=self.version), ensure_ascii=False, separators=(',', ':'))
+        compressed = gzip.compress(encoded.encode('utf-8'))
+
+        # written next to the target and renamed, a crash never leaves a half written file behind
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(prefix=".heos_state.", dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(compressed)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def _read(self) -> typing.Optional[dict]:
+        try:
+            with gzip.open(self.path, 'rb') as file:
+                data = json.loads(file.read().decode('utf-8'))
+        except (OSError, EOFError, ValueError, zlib.error):
+            return None
+
+        if not isinstance(data, dict) or data.get("version") != self.version:
+            return None
+        return data
+
+    async def save(self, data: dict):
+        await asyncio.get_event_loop().run_in_executor(None, self._write, data)
+
+    async def load(self) -> typing.Optional[dict]:
+        return await asyncio.get_event_loop().run_in_executor(None, self._read)
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import time
+import typing
+
+import heos.connection
+import heos.protocol
+
+logger = logging.getLogger(__name__)
+
+
+class HeosEventSubscription:
+    def __init__(self, manager, heartbeat_interval: float = 10.0, heartbeat_timeout: float = 5.0,
+                 retry_interval: float = 5.0):
+        self.manager = manager
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.retry_interval = retry_interval
+
+        self.primary_ip: typing.Optional[str] = None
+        self.connection: typing.Optional[heos.connection.HeosConnection] = None
+        self.failovers = 0
+        self.last_failover_time = 0.0
+        self.missed_events = 0
+        self.handler_errors = 0
+
+        self._running = False
+        self._task: typing.Optional[asyncio.Task] = None
+
+    def _candidate_ips(self) -> typing.List[str]:
+        ips = list(dict.fromkeys(device.ip for device in self.manager.get_all_devices()))
+        if self.primary_ip in ips:
+            # start with the speaker after the current one, so a dead primary is tried last
+            index = ips.index(self.primary_ip) + 1
+            ips = ips[index:] + ips[:index]
+        return ips
+
+    async def _subscribe(self, ip: str) -> heos.connection.HeosConnection:
+        connection = heos.connection.HeosConnection(ip, self.manager.connection_pool.port, self.heartbeat_timeout)
+        try:
+            await connection.open()
+            await connection.write(b'heos://system/register_for_change_events?enable=on')
+            await connection.read_message(self.heartbeat_timeout)
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    async def _connect(self) -> bool:
+        for ip in self._candidate_ips():
+            try:
+                self.connection = await self._subscribe(ip)
+            except (asyncio.TimeoutError, OSError, EOFError):
+                continue
+
+            self.primary_ip = ip
+            return True
+
+        return False
+
+    async def start(self) -> bool:
+        if self._running:
+            return True
+
+        if not await self._connect():
+            return False
+
+        self._running = True
+        self._task = asyncio.ensure_future(self._run())
+        return True
+
+    def stop(self):
+        self._running = False
+        if self._task:
+            self._task.cancel()
+        if self.connection:
+            self.connection.close()
+
+    async def _read(self) -> dict:
+        try:
+            return await self.connection.read_message(self.heartbeat_interval)
+        except asyncio.TimeoutError:
+            pass
+
+        # silence on the subscription, a living speaker answers the heart beat on the same socket
+        await self.connection.write(b'heos://system/heart_beat')
+        return await self.connection.read_message(self.heartbeat_timeout)
+
+    async def _run(self):
+        while self._running:
+            try:
+                response = await self._read()
+            except (asyncio.TimeoutError, OSError, EOFError, heos.protocol.HeosProtocolError):
+                await self._failover()
+                continue
+
+            try:
+                is_event = await self.manager._handle_event(response)
+            except Exception:
+                # a failing handler loses this one event, the subscription has to go on for all others
+                self.handler_errors += 1
+                logger.exception("HEOS event handler failed for %s", response)
+                continue
+
+            if is_event:
+                self.manager.event_stats.add(time.perf_counter() - self.connection.last_received)
+
+    async def _failover(self):
+        started = time.monotonic()
+        old_primary_ip = self.primary_ip
+        self.connection.close()
+
+        while self._running and not await self._connect():
+            await asyncio.sleep(self.retry_interval)
+
+        if not self._running:
+            return
+
+        self.failovers += 1
+        self.last_failover_time = time.monotonic() - started
+        # state changes which happened without a subscription are caught up by a resync
+        missed_events = 0
+        try:
+            missed_events = await self.manager.resync_devices()
+            self.missed_events += missed_events
+        except Exception:
+            self.handler_errors += 1
+            logger.exception("HEOS resync after failover failed")
+
+        logger.warning("HEOS event subscription failed over from %s to %s in %.2f s, %d missed events",
+                       old_primary_ip, self.primary_ip, self.last_failover_time, missed_events)
+
+    def stats(self) -> dict:
+        return {
+            "primary_ip": self.primary_ip,
+            "failovers": self.failovers,
+            "last_failover_seconds": self.last_failover_time,
+            "missed_events": self.missed_events,
+            "handler_errors": self.handler_errors,
+        }
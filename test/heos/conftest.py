@@ -0,0 +1,92 @@
+import asyncio
+import urllib.parse
+
+import pytest
+
+from heos.cache import HeosBrowseCache
+from heos.manager import HeosDeviceManager
+from heos.sources import HeosSourceBase
+
+
+class MockHeosSystem:
+    def __init__(self, players: int = 3, delay: float = 0.0):
+        self.delay = delay
+        self.calls = list()
+        self.players = [{
+            "pid": i + 1,
+            "name": "Player " + str(i + 1),
+            "model": "mock",
+            "version": "1.0",
+            "ip": "192.168.1." + str(i + 1),
+            "network": "wifi",
+            "serial": "serial" + str(i + 1),
+        } for i in range(players)]
+        self.state = {player["pid"]: {
+            "state": "play",
+            "level": 20 + player["pid"],
+            "mute": "off",
+            "repeat": "on_all",
+        } for player in self.players}
+        self.sources = [
+            {"name": "Online", "type": "music_service", "sid": 1, "available": "true"},
+            {"name": "Local Music", "type": "heos_server", "sid": 1024, "available": "true"},
+        ]
+        # browse results keyed by (sid, cid), cid is empty for the source itself
+        self.browse_results = {
+            (1024, ""): [{"name": "Server", "type": "heos_server", "cid": "server", "container": "yes"}],
+            (1024, "server"): [{"name": "Track", "type": "song", "mid": "m1", "container": "no"}],
+        }
+
+    def ips(self) -> list:
+        return [player["ip"] for player in self.players]
+
+    async def send_telnet_message(self, ip, command: bytes) -> dict:
+        self.calls.append((ip, command))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+
+        url = urllib.parse.urlparse(command.decode())
+        name = (url.netloc + url.path).replace("//", "/")
+        params = dict(urllib.parse.parse_qsl(url.query))
+        result = {"heos": {"command": name, "result": "success", "message": url.query}}
+
+        pid = int(params.get("pid", 0))
+        if name == "player/get_players":
+            result["payload"] = self.players
+        elif name == "player/get_play_state":
+            result["heos"]["message"] += "&state=" + self.state[pid]["state"]
+        elif name == "player/get_volume":
+            result["heos"]["message"] += "&level=" + str(self.state[pid]["level"])
+        elif name == "player/get_mute":
+            result["heos"]["message"] += "&state=" + self.state[pid]["mute"]
+        elif name == "player/get_play_mode":
+            result["heos"]["message"] += "&repeat=" + self.state[pid]["repeat"] + "&shuffle=off"
+        elif name == "player/get_now_playing_media":
+            result["payload"] = {"type": "song", "song": "Song " + str(pid)}
+        elif name == "player/set_volume":
+            self.state[pid]["level"] = int(params["level"])
+        elif name == "browse/get_music_sources":
+            result["payload"] = self.sources
+        elif name == "browse/get_source_info":
+            result["payload"] = [source for source in self.sources if source["sid"] == int(params["sid"])]
+        elif name == "browse/get_search_criteria":
+            result["payload"] = []
+        elif name == "browse/browse":
+            items = self.browse_results.get((int(params["sid"]), params.get("cid", "")), [])
+            start, end = (int(value) for value in params.get("range", "0,99").split(","))
+            result["payload"] = items[start:end + 1]
+            result["heos"]["message"] += "&returned=" + str(len(result["payload"])) + "&count=" + str(len(items))
+
+        return result
+
+    def count(self, name: bytes) -> int:
+        return sum(1 for _, command in self.calls if name in command)
+
+
+@pytest.fixture
+def mock_heos(monkeypatch):
+    system = MockHeosSystem()
+    monkeypatch.setattr(HeosDeviceManager, "send_telnet_message", system.send_telnet_message)
+    # browse results of an earlier mock system must not answer for this one
+    monkeypatch.setattr(HeosSourceBase, "browse_cache", HeosBrowseCache())
+    yield system
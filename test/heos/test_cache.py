@@ -0,0 +1,55 @@
+import time
+
+from heos.cache import HeosBrowseCache
+
+
+def test_browse_cache_hit_and_miss():
+    cache = HeosBrowseCache()
+    assert cache.get((1024, "c", 0, 99)) is None
+
+    cache.put((1024, "c", 0, 99), [{"name": "a"}], 1)
+    assert cache.get((1024, "c", 0, 99)) == ([{"name": "a"}], 1)
+    assert cache.get((1024, "c", 100, 199)) is None
+    assert cache.stats() == {"entries": 1, "items": 1, "hits": 1, "misses": 2}
+
+
+def test_browse_cache_ttl(monkeypatch):
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    cache = HeosBrowseCache(default_ttl=10)
+    cache.ttls[1] = 0
+
+    cache.put((1024, "", 0, 99), [], 0)
+    cache.put((1, "", 0, 99), [], 0)
+    assert cache.get((1, "", 0, 99)) is None
+
+    now += 9
+    assert cache.get((1024, "", 0, 99)) is not None
+    now += 2
+    assert cache.get((1024, "", 0, 99)) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_browse_cache_lru_cap():
+    cache = HeosBrowseCache(max_items=250)
+    for start in (0, 100, 200):
+        cache.put((1024, "c", start, start + 99), [{}] * 100, 300)
+        cache.get((1024, "c", 0, 99))
+
+    # the first page was used last, the second one is evicted
+    assert cache.get((1024, "c", 100, 199)) is None
+    assert cache.get((1024, "c", 0, 99)) is not None
+    assert cache.stats()["items"] == 200
+
+
+def test_browse_cache_invalidate():
+    cache = HeosBrowseCache()
+    cache.put((1024, "c", 0, 99), [{}], 1)
+    cache.put((1025, "c", 0, 99), [{}], 1)
+
+    cache.invalidate(1024)
+    assert cache.get((1024, "c", 0, 99)) is None
+    assert cache.get((1025, "c", 0, 99)) is not None
+
+    cache.invalidate()
+    assert cache.stats()["entries"] == 0
@@ -0,0 +1,170 @@
+import asyncio
+import json
+import socketserver
+import threading
+import time
+
+import pytest
+
+from heos.connection import HeosConnectionPool, HeosPipelinedClient
+from heos.manager import HeosDeviceManager
+
+
+class MockHeosHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.connections += 1
+        write_lock = threading.Lock()
+        for line in self.rfile:
+            threading.Thread(target=self.answer, args=(line.strip().decode(), write_lock), daemon=True).start()
+            if self.server.drop_after_response:
+                time.sleep(0.05)
+                return
+
+    def answer(self, line: str, write_lock: threading.Lock):
+        command, _, message = line[len("heos://"):].partition("?")
+        if command == "test/hang" or self.server.silent:
+            return
+        if command == "test/slow":
+            self.send(write_lock, command, "command under process&" + message)
+            time.sleep(0.5)
+
+        self.send(write_lock, command, message)
+
+    def send(self, write_lock: threading.Lock, command: str, message: str):
+        with write_lock:
+            self.wfile.write(json.dumps({
+                "heos": {
+                    "command": command,
+                    "result": "success",
+                    "message": message
+                }
+            }).encode() + b"\r\n")
+
+
+@pytest.fixture
+def mock_server():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), MockHeosHandler)
+    server.daemon_threads = True
+    server.connections = 0
+    server.drop_after_response = False
+    server.silent = False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def pool(monkeypatch, mock_server):
+    pool = HeosConnectionPool(port=mock_server.server_address[1])
+    monkeypatch.setattr(HeosDeviceManager, "connection_pool", pool)
+    yield pool
+    pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_pool_reuses_connection(mock_server, pool):
+    for _ in range(5):
+        data = await HeosDeviceManager.send_telnet_message("127.0.0.1", b'heos://system/heart_beat')
+        assert data["heos"]["command"] == "system/heart_beat"
+
+    assert mock_server.connections == 1
+    assert pool.stats() == {"open": 1, "idle": 1, "in_flight": 0, "reconnects": 0}
+
+
+@pytest.mark.asyncio
+async def test_pool_reconnects_after_drop(mock_server, pool):
+    mock_server.drop_after_response = True
+
+    for _ in range(3):
+        data = await HeosDeviceManager.send_telnet_message("127.0.0.1", b'heos://system/heart_beat')
+        assert data["heos"]["result"] == "success"
+        await asyncio.sleep(0.1)
+
+    assert mock_server.connections == 3
+    assert pool.stats()["open"] <= 1
+    assert pool.stats()["reconnects"] == 2
+
+
+@pytest.mark.asyncio
+async def test_pool_evicts_idle(pool):
+    await HeosDeviceManager.send_telnet_message("127.0.0.1", b'heos://system/heart_beat')
+    assert pool.stats()["idle"] == 1
+
+    pool.idle_timeout = 0
+    pool.evict_idle()
+
+    assert pool.stats() == {"open": 0, "idle": 0, "in_flight": 0, "reconnects": 0}
+
+
+@pytest.mark.asyncio
+async def test_pool_read_timeout(mock_server, pool):
+    pool.timeout = 0.2
+    mock_server.silent = True
+
+    # a speaker which accepts but never answers, each timeout gives up the socket
+    for _ in range(3):
+        with pytest.raises(asyncio.TimeoutError):
+            await HeosDeviceManager.send_telnet_message("127.0.0.1", b'heos://system/heart_beat')
+
+    assert pool.stats() == {"open": 0, "idle": 0, "in_flight": 0, "reconnects": 2}
+    assert mock_server.connections == 3
+
+
+@pytest.mark.asyncio
+async def test_pool_read_timeout_keeps_answering_socket(mock_server, pool):
+    pool.timeout = 0.2
+
+    with pytest.raises(asyncio.TimeoutError):
+        await HeosDeviceManager.send_telnet_message("127.0.0.1", b'heos://test/hang')
+
+    # the speaker answered the heart beat, only the one command got lost
+    data = await HeosDeviceManager.send_telnet_message("127.0.0.1", b'heos://system/heart_beat')
+    assert data["heos"]["command"] == "system/heart_beat"
+    assert mock_server.connections == 1
+
+
+@pytest.mark.asyncio
+async def test_slow_command_does_not_block_others(mock_server, pool):
+    slow = asyncio.ensure_future(HeosDeviceManager.send_telnet_message("127.0.0.1", b'heos://test/slow?pid=1'))
+    await asyncio.sleep(0.05)
+
+    start = time.monotonic()
+    data = await HeosDeviceManager.send_telnet_message("127.0.0.1", b'heos://player/set_volume?pid=1&level=5')
+    assert time.monotonic() - start < 0.3
+    assert data["heos"]["message"] == "pid=1&level=5&SEQUENCE=2"
+    assert not slow.done()
+
+    data = await slow
+    assert data["heos"]["command"] == "test/slow"
+    assert data["heos"]["message"] == "pid=1&SEQUENCE=1"
+    assert mock_server.connections == 1
+
+
+@pytest.mark.asyncio
+async def test_interim_reply_extends_timeout(mock_server):
+    client = HeosPipelinedClient("127.0.0.1", mock_server.server_address[1], timeout=0.4)
+
+    data = await client.request(b'heos://test/slow?pid=1')
+    assert data["heos"]["message"] == "pid=1&SEQUENCE=1"
+    client.close()
+
+
+@pytest.mark.asyncio
+async def test_in_flight_limit(mock_server):
+    client = HeosPipelinedClient("127.0.0.1", mock_server.server_address[1], max_in_flight=2)
+
+    requests = [asyncio.ensure_future(client.request(b'heos://test/slow?pid=' + str(i).encode())) for i in range(3)]
+    await asyncio.sleep(0.2)
+    assert client.in_flight == 2
+
+    results = await asyncio.gather(*requests)
+    assert [data["heos"]["message"].split("&")[0] for data in results] == ["pid=0", "pid=1", "pid=2"]
+    client.close()
+
+
+def test_tag_command():
+    assert HeosPipelinedClient.tag_command(b'heos://system/heart_beat', 3) == b'heos://system/heart_beat?SEQUENCE=3'
+    assert HeosPipelinedClient.tag_command(b'heos://player/get_volume?pid=1', 4) == \
+        b'heos://player/get_volume?pid=1&SEQUENCE=4'
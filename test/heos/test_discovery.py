@@ -0,0 +1,195 @@
+import asyncio
+import time
+
+import pytest
+
+from heos.connection import HeosConnectionPool
+from heos.discovery import HeosDiscoveryService
+from heos.manager import HeosDeviceManager
+
+
+def get_device(mock_heos, index: int) -> dict:
+    player = mock_heos.players[index]
+    return {'udn': 'uuid:' + player["serial"], 'name': player["name"], 'host': player["ip"], 'port': 60006,
+            'type': 'urn:schemas-denon-com:device:AiosServices:1', 'base_url': '', 'services': []}
+
+
+@pytest.fixture
+def discovered(monkeypatch):
+    devices = list()
+
+    async def start_watch_events(self):
+        pass
+
+    monkeypatch.setattr(HeosDiscoveryService, "_discover", staticmethod(lambda timeout: list(devices)))
+    # the mock speakers do not exist, there is nothing to subscribe to
+    monkeypatch.setattr(HeosDeviceManager, "start_watch_events", start_watch_events)
+    yield devices
+
+
+@pytest.mark.asyncio
+async def test_discovery_announces_new_speakers(mock_heos, discovered):
+    heos_manager = HeosDeviceManager()
+    changes = list()
+
+    async def on_change():
+        changes.append(len(heos_manager.get_all_devices()))
+
+    service = HeosDiscoveryService(heos_manager, on_change=on_change)
+    discovered.append(get_device(mock_heos, 0))
+
+    new, lost = await service.scan()
+    assert [device['host'] for device in new] == ["192.168.1.1"] and not lost
+    assert len(heos_manager.get_all_devices()) == 3
+    assert service.devices_by_ip["192.168.1.1"]['udn'] == "uuid:serial1"
+    assert changes == [3]
+
+    # nothing changed, nothing announced
+    assert await service.scan() == ([], [])
+    assert changes == [3]
+
+    discovered.append(get_device(mock_heos, 1))
+    new, _ = await service.scan()
+    assert [device['udn'] for device in new] == ["uuid:serial2"]
+    assert sorted(service.devices) == ["uuid:serial1", "uuid:serial2"]
+
+
+@pytest.mark.asyncio
+async def test_discovery_announces_lost_speakers(mock_heos, discovered):
+    heos_manager = HeosDeviceManager()
+    service = HeosDiscoveryService(heos_manager, lost_after=2)
+    discovered.extend([get_device(mock_heos, 0), get_device(mock_heos, 2)])
+    await service.scan()
+
+    discovered.pop()
+    mock_heos.players.pop()
+    assert await service.scan() == ([], [])
+
+    _, lost = await service.scan()
+    assert [device['host'] for device in lost] == ["192.168.1.3"]
+    assert "192.168.1.3" not in service.devices_by_ip
+    assert heos_manager.get_device_by_pid(3) is None
+    assert heos_manager._ips == ["192.168.1.1"]
+
+
+@pytest.mark.asyncio
+async def test_discovery_runs_off_the_event_loop(monkeypatch):
+    def blocking_discover(timeout):
+        time.sleep(timeout)
+        return list()
+
+    monkeypatch.setattr(HeosDiscoveryService, "_discover", staticmethod(blocking_discover))
+    service = HeosDiscoveryService(timeout=0.2)
+
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    ticker = asyncio.ensure_future(tick())
+    await service.scan()
+    ticker.cancel()
+
+    assert ticks > 10
+
+
+@pytest.mark.asyncio
+async def test_discovery_runs_periodically(mock_heos, discovered):
+    service = HeosDiscoveryService(HeosDeviceManager(), interval=0.01)
+    service.start()
+    await asyncio.sleep(0.02)
+    discovered.append(get_device(mock_heos, 0))
+    await asyncio.sleep(0.05)
+    service.stop()
+
+    assert list(service.devices) == ["uuid:serial1"]
+
+
+@pytest.mark.asyncio
+async def test_discovery_retries_failed_announce(mock_heos, discovered, monkeypatch):
+    heos_manager = HeosDeviceManager()
+    service = HeosDiscoveryService(heos_manager, interval=0.01)
+    discovered.append(get_device(mock_heos, 0))
+
+    async def initialize(self, list_of_ips):
+        raise KeyError("payload")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(HeosDeviceManager, "initialize", initialize)
+        service.start()
+        await asyncio.sleep(0.05)
+        # the failed speaker is not recorded and the service keeps running
+        assert not service.devices
+        assert not service._task.done()
+
+    await asyncio.sleep(0.05)
+    service.stop()
+
+    assert list(service.devices) == ["uuid:serial1"]
+    assert len(heos_manager.get_all_devices()) == 3
+
+
+@pytest.mark.asyncio
+async def test_discovery_survives_failing_speaker(mock_heos, discovered, monkeypatch):
+    send_telnet_message = mock_heos.send_telnet_message
+
+    async def refusing_send_telnet_message(ip, command: bytes) -> dict:
+        if ip == "192.168.1.2":
+            raise ConnectionRefusedError()
+        return await send_telnet_message(ip, command)
+
+    watch_calls = list()
+
+    async def start_watch_events(self):
+        watch_calls.append(len(self.get_all_devices()))
+
+    monkeypatch.setattr(HeosDeviceManager, "send_telnet_message", refusing_send_telnet_message)
+    monkeypatch.setattr(HeosDeviceManager, "start_watch_events", start_watch_events)
+    heos_manager = HeosDeviceManager()
+    service = HeosDiscoveryService(heos_manager)
+    discovered.extend(get_device(mock_heos, index) for index in range(3))
+
+    new, _ = await service.scan()
+    assert len(new) == 3
+    assert sorted(service.devices_by_ip) == mock_heos.ips()
+    assert [source.sid for source in heos_manager.get_all_sources()] == [1, 1024]
+    assert heos_manager.get_source_by_id(1024)._ip == "192.168.1.1"
+
+    # the subscription is tried on every scan until it runs
+    assert await service.scan() == ([], [])
+    assert watch_calls == [3, 3]
+
+
+@pytest.mark.asyncio
+async def test_discovery_follows_moved_speaker(mock_heos, discovered):
+    heos_manager = HeosDeviceManager()
+    service = HeosDiscoveryService(heos_manager)
+    discovered.extend(get_device(mock_heos, index) for index in range(3))
+    await service.scan()
+
+    mock_heos.players[1]["ip"] = "10.0.0.2"
+    discovered[1] = get_device(mock_heos, 1)
+    assert await service.scan() == ([], [])
+
+    assert heos_manager.get_device_by_pid(2).ip == "10.0.0.2"
+    assert heos_manager._ips == ["192.168.1.1", "10.0.0.2", "192.168.1.3"]
+    assert service.devices["uuid:serial2"]['host'] == "10.0.0.2"
+    assert "192.168.1.2" not in service.devices_by_ip
+
+
+@pytest.mark.asyncio
+async def test_discovery_evicts_idle_connections(discovered, monkeypatch):
+    pool = HeosConnectionPool(idle_timeout=0.01)
+    monkeypatch.setattr(HeosDeviceManager, "connection_pool", pool)
+    client = pool._get_client("192.168.1.1")
+    client.last_used -= 1
+
+    service = HeosDiscoveryService(HeosDeviceManager(), interval=0.01)
+    service.start()
+    await asyncio.sleep(0.05)
+    service.stop()
+
+    assert pool._clients["192.168.1.1"] == []
@@ -1,7 +1,10 @@
+import gc
+
 import pytest
 import asyncio
 
-from heos import ServerHeosEvent, EventQueueManager
+from heos import ServerHeosEvent, EventQueueManager, EventSubscriber, SubscriberDisconnected, EventFilter, \
+    coalesce_events
 
 
 def test_server_heos_event_init():
@@ -22,35 +25,155 @@ def test_server_heos_event_encode(data):
     assert data.encode('utf-8') in message
 
 
+def test_server_heos_event_encode_once():
+    she = ServerHeosEvent({"event": "player_volume_changed", "message": "pid=1&level=5", "full": {"heos": {}}})
+
+    message = she.encode()
+    assert message is she.encode()
+    assert message == b'id: 1\nEvent: event\ndata: {"event":"player_volume_changed","message":"pid=1&level=5",' \
+                      b'"full":{"heos":{}}}\n\n'
+
+    she.id = 7
+    assert she.encode().startswith(b'id: 7\n')
+
+
+def test_server_heos_event_encode_slim():
+    she = ServerHeosEvent({"event": "player_volume_changed", "message": "pid=1&level=5", "full": {"heos": {}}})
+
+    slim = she.encode(slim=True)
+    assert slim is she.encode(slim=True)
+    assert b'"full"' not in slim
+    assert b'"message":"pid=1&level=5"' in slim
+    assert b'"full"' in she.encode()
+
+
 @pytest.mark.asyncio
-async def test_event_queue_manager_get_queue():
-    queue = EventQueueManager.get_queue()
-    assert queue in EventQueueManager._queues
-    assert queue.empty()
+async def test_event_queue_manager_subscribe():
+    subscriber = EventQueueManager.subscribe()
+    assert subscriber in EventQueueManager._subscribers
+    assert subscriber.empty()
 
     EventQueueManager.add_event(ServerHeosEvent("Test"))
-    assert not queue.empty()
+    assert not subscriber.empty()
 
-    event = await queue.get()
+    event = await subscriber.get()
     assert event
     assert event.data == "Test"
+    assert subscriber.empty()
+
+    subscriber.close()
+    assert subscriber not in EventQueueManager._subscribers
+
+
+@pytest.mark.asyncio
+async def test_event_queue_shared_between_subscribers():
+    first = EventQueueManager.subscribe()
+    second = EventQueueManager.subscribe()
+
+    for i in range(3):
+        EventQueueManager.add_event(ServerHeosEvent(i))
+
+    assert [(await first.get()).data for _ in range(3)] == [0, 1, 2]
+    assert [(await second.get()).data for _ in range(3)] == [0, 1, 2]
+    assert first.empty()
+
+    first.close()
+    second.close()
+
+
+@pytest.mark.asyncio
+async def test_event_queue_wakes_waiting_subscriber():
+    subscriber = EventQueueManager.subscribe()
+    waiting = asyncio.ensure_future(subscriber.get())
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
 
-    EventQueueManager._queues.remove(queue)
+    EventQueueManager.add_event(ServerHeosEvent("wake"))
+    event = await asyncio.wait_for(waiting, 1)
+    assert event.data == "wake"
+
+    subscriber.close()
+
+
+@pytest.mark.asyncio
+async def test_event_queue_slow_subscriber_drop_oldest():
+    subscriber = EventQueueManager.subscribe()
+
+    for i in range(EventQueueManager.buffer_size + 10):
+        EventQueueManager.add_event(ServerHeosEvent(i))
+
+    event = await subscriber.get()
+    assert event.data == 10
+    assert subscriber.dropped == 10
+    assert subscriber in EventQueueManager._subscribers
+
+    subscriber.close()
 
 
 @pytest.mark.asyncio
-async def test_event_queue_full():
-    queue = EventQueueManager.get_queue()
-    assert queue in EventQueueManager._queues
+async def test_event_queue_slow_subscriber_disconnect():
+    subscriber = EventQueueManager.subscribe(EventSubscriber.DISCONNECT)
 
     for i in range(0, 2048):
         EventQueueManager.add_event(ServerHeosEvent(i))
 
-    assert queue.full()
+    assert subscriber in EventQueueManager._subscribers
 
     EventQueueManager.add_event(ServerHeosEvent("full"))
 
-    await asyncio.sleep(1)
+    assert subscriber not in EventQueueManager._subscribers
+    with pytest.raises(SubscriberDisconnected) as e:
+        await subscriber.get()
+    assert "slow subscriber" in e.value.reason
+
+
+def test_event_queue_forgotten_subscriber_removed():
+    gc.collect()
+    count = len(EventQueueManager._subscribers)
+    EventQueueManager.subscribe()
+    gc.collect()
+
+    assert len(EventQueueManager._subscribers) == count
+
+
+def _heos_event(event: str, message: str) -> ServerHeosEvent:
+    return ServerHeosEvent({"command": "event/" + event, "event": event, "message": message})
+
+
+def test_event_filter():
+    volume = _heos_event("player_volume_changed", "pid=1&level=5&mute=off")
+    state = _heos_event("player_state_changed", "pid=2&state=play")
+    group = _heos_event("group_volume_changed", "gid=7&level=5&mute=off")
+
+    assert not EventFilter()
+    assert EventFilter().matches(volume)
+
+    pid_filter = EventFilter(pids=[1])
+    assert pid_filter.matches(volume)
+    assert not pid_filter.matches(state)
+
+    event_filter = EventFilter(pids=[1, 2], events=["player_state_changed"])
+    assert not event_filter.matches(volume)
+    assert event_filter.matches(state)
+
+    group_filter = EventFilter(groups=[7])
+    assert group_filter.matches(group)
+    assert not group_filter.matches(volume)
+
 
-    assert queue not in EventQueueManager._queues
+def test_coalesce_events():
+    events = [
+        _heos_event("player_now_playing_progress", "pid=1&cur_pos=1000&duration=5000"),
+        _heos_event("player_volume_changed", "pid=1&level=5&mute=off"),
+        _heos_event("player_now_playing_progress", "pid=2&cur_pos=1000&duration=5000"),
+        _heos_event("player_state_changed", "pid=1&state=play"),
+        _heos_event("player_now_playing_progress", "pid=1&cur_pos=2000&duration=5000"),
+        _heos_event("player_volume_changed", "pid=1&level=9&mute=off"),
+    ]
 
+    assert [event.data["message"] for event in coalesce_events(events)] == [
+        "pid=2&cur_pos=1000&duration=5000",
+        "pid=1&state=play",
+        "pid=1&cur_pos=2000&duration=5000",
+        "pid=1&level=9&mute=off",
+    ]
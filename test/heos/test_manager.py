@@ -1,6 +1,14 @@
+import asyncio
+import json
+import time
+
 import pytest
 
+import heos.protocol
+import heos.sources
+from heos.connection import HeosConnectionPool
 from heos.manager import HeosDevice, HeosDeviceManager, HeosEventCallback
+from heos.store import HeosStateStore
 
 
 @pytest.fixture
@@ -264,3 +272,429 @@ def test_get_heos_decorators2():
     assert data
     assert "update_status" in data
     assert "update_volume" in data
+
+
+@pytest.mark.asyncio
+async def test_initialize_concurrent(mock_heos):
+    mock_heos.delay = 0.02
+    heos_manager = HeosDeviceManager()
+    await heos_manager.initialize(mock_heos.ips())
+
+    assert sorted(heos_manager._all_devices) == [1, 2, 3]
+    assert heos_manager._all_devices[2].volume == 22
+    assert sorted(heos_manager._all_sources) == [1, 1024]
+    assert mock_heos.count(b'get_players') == 1
+
+
+@pytest.mark.asyncio
+async def test_initialize_concurrent_faster_than_serial(mock_heos):
+    mock_heos.delay = 0.02
+
+    serial_manager = HeosDeviceManager()
+    start = time.monotonic()
+    await serial_manager.initialize(mock_heos.ips(), concurrent=False)
+    serial_time = time.monotonic() - start
+
+    concurrent_manager = HeosDeviceManager()
+    start = time.monotonic()
+    await concurrent_manager.initialize(mock_heos.ips())
+    concurrent_time = time.monotonic() - start
+
+    assert concurrent_manager._all_devices.keys() == serial_manager._all_devices.keys()
+    assert concurrent_manager._all_sources.keys() == serial_manager._all_sources.keys()
+    assert concurrent_time < serial_time / 2
+
+
+@pytest.mark.asyncio
+async def test_refresh_state(mock_heos):
+    device = HeosDevice(mock_heos.players[1], doUpdate=False)
+    await device.refresh_state()
+
+    assert device.play_state == "play"
+    assert device.volume == 22
+    assert not device.is_muted
+    assert device.now_playing == {"type": "song", "song": "Song 2"}
+    assert device.repeat == "on_all"
+
+
+@pytest.mark.asyncio
+async def test_refresh_state_cold_start_latency(mock_heos):
+    mock_heos.delay = 0.05
+    device = HeosDevice(mock_heos.players[0], doUpdate=False)
+
+    start = time.monotonic()
+    await device.refresh_state()
+    latency = time.monotonic() - start
+
+    # all five status queries are in flight together instead of one after another
+    assert latency < 2 * mock_heos.delay
+    assert len(mock_heos.calls) == 5
+
+
+@pytest.mark.asyncio
+async def test_refresh_state_deduplicated(mock_heos):
+    mock_heos.delay = 0.01
+    device = HeosDevice(mock_heos.players[0], doUpdate=False)
+
+    await asyncio.gather(device.refresh_state(), device.refresh_state(), device.initialize())
+    assert len(mock_heos.calls) == 5
+
+    await device.refresh_state()
+    assert len(mock_heos.calls) == 10
+
+
+def test_event_dispatch_table():
+    table = HeosEventCallback.get_dispatch_table(HeosDevice)
+
+    assert [callback.func_name for callback in table["player_volume_changed"]] == ["update_volume"]
+    assert table["player_volume_changed"][0].param_names == ("level", "mute")
+    assert [callback.func_name for callback in table["repeat_mode_changed"]] == ["update_repeat_mode"]
+    assert "test_event_2711" not in table
+
+
+@pytest.mark.asyncio
+async def test_handle_event(heos_device):
+    heos_manager = HeosDeviceManager()
+    heos_manager.add_device(heos_device)
+
+    await heos_manager._handle_event({
+        "heos": {
+            "command": "event/player_volume_changed",
+            "message": "pid=1234&level=33&mute=on"
+        }
+    })
+
+    assert heos_device.volume == 33
+    assert heos_device.is_muted
+
+    await heos_manager._handle_event({
+        "heos": {
+            "command": "event/player_volume_changed",
+            "message": "pid=999&level=50&mute=off"
+        }
+    })
+
+    assert heos_device.volume == 33
+
+
+@pytest.mark.asyncio
+async def test_update_status_missing_field(monkeypatch, heos_device):
+    heos_device.play_state = "pause"
+
+    async def mock_telnet(ip, command):
+        return {
+            "heos": {
+                "command": "player/get_play_state",
+                "result": "success",
+                "message": "pid=1234"
+            }
+        }
+
+    monkeypatch.setattr(HeosDeviceManager, "send_telnet_message", mock_telnet)
+
+    await heos_device.update_status()
+    await heos_device.update_volume_force()
+    await heos_device.update_repeat_mode_force()
+    assert heos_device.play_state == "pause"
+
+
+@pytest.mark.slow
+@pytest.mark.asyncio
+async def test_handle_event_throughput(heos_device):
+    heos_manager = HeosDeviceManager()
+    heos_manager.add_device(heos_device)
+    events = [{
+        "heos": {
+            "command": "event/player_now_playing_progress",
+            "message": "pid=1234&cur_pos=" + str(i) + "&duration=240000"
+        }
+    } for i in range(10000)]
+
+    start = time.perf_counter()
+    for event in events:
+        await heos_manager._handle_event(event)
+    elapsed = time.perf_counter() - start
+
+    assert heos_device.now_playing["cur_pos"] == "9999"
+    assert len(events) / elapsed > 5000, f"{len(events) / elapsed:.0f} events/s"
+
+
+@pytest.mark.asyncio
+async def test_watch_events_push_driven(monkeypatch, heos_device):
+    writers = list()
+
+    async def handle(reader, writer):
+        await reader.readline()
+        writer.write(json.dumps({"heos": {
+            "command": "system/register_for_change_events", "result": "success", "message": "enable=on"
+        }}).encode() + b"\r\n")
+        writers.append(writer)
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    monkeypatch.setattr(HeosDeviceManager, "connection_pool",
+                        HeosConnectionPool(port=server.sockets[0].getsockname()[1]))
+
+    heos_device.ip = "127.0.0.1"
+    heos_manager = HeosDeviceManager()
+    heos_manager.add_device(heos_device)
+    await heos_manager.start_watch_events()
+
+    writers[0].write(b"".join(json.dumps({"heos": {
+        "command": "event/player_volume_changed", "message": "pid=1234&level=" + str(level) + "&mute=off"
+    }}).encode() + b"\r\n" for level in range(1, 51)))
+
+    start = time.monotonic()
+    while heos_manager.event_stats.count < 50 and time.monotonic() - start < 1:
+        await asyncio.sleep(0.001)
+
+    assert heos_device.volume == 50
+    assert heos_manager.event_stats.count == 50
+    assert heos_manager.event_stats.to_dict()["mean_latency_ms"] < 10
+
+    await heos_manager.stop_watch_events()
+    server.close()
+
+
+@pytest.mark.asyncio
+async def test_volume_control_coalesces_burst(mock_heos):
+    mock_heos.delay = 0.02
+    device = HeosDevice(mock_heos.players[0], doUpdate=False)
+    device.volume = 20
+
+    first = asyncio.ensure_future(device.volume_control.step(2))
+    await asyncio.sleep(0.005)
+    results = await asyncio.gather(first, *(device.volume_control.step(2) for _ in range(4)),
+                                   device.volume_control.step(-2))
+
+    assert device.volume == 28
+    assert mock_heos.state[1]["level"] == 28
+    assert all(result == (True, 28) for result in results)
+    # the first request goes out at once, everything queued behind it collapses into one more
+    assert mock_heos.count(b'set_volume') == 2
+    assert device.volume_control.target is None
+
+
+@pytest.mark.asyncio
+async def test_volume_control_clamps(mock_heos):
+    device = HeosDevice(mock_heos.players[0], doUpdate=False)
+
+    assert await device.volume_control.set(120) == (True, 100)
+    assert await device.volume_control.step(-200) == (True, 0)
+
+
+@pytest.mark.asyncio
+async def test_indexes_after_initialize(mock_heos):
+    heos_manager = HeosDeviceManager()
+    await heos_manager.initialize(mock_heos.ips())
+
+    assert heos_manager.get_device_by_name("Player 2") is heos_manager._all_devices[2]
+    assert heos_manager.get_device_by_pid(3).name == "Player 3"
+    assert heos_manager.get_device_by_name("Unknown") is None
+    assert [device.pid for device in heos_manager.get_all_devices()] == [1, 2, 3]
+    assert heos_manager.get_source_by_id(1024) is heos_manager._all_sources[1024]
+    assert heos_manager.get_source_by_id("1") is heos_manager._all_sources[1]
+    assert heos_manager.get_source_by_id(5) is None
+
+
+@pytest.mark.asyncio
+async def test_players_changed_updates_indexes(mock_heos):
+    heos_manager = HeosDeviceManager()
+    await heos_manager.initialize(mock_heos.ips())
+    device = heos_manager.get_device_by_name("Player 1")
+
+    mock_heos.players[0]["name"] = "Kitchen"
+    mock_heos.players.pop(2)
+    await heos_manager._handle_event({"heos": {"command": "event/players_changed", "message": ""}})
+    await heos_manager.wait_for_system_jobs()
+
+    assert heos_manager.get_device_by_name("Kitchen") is device
+    assert heos_manager.get_device_by_name("Player 1") is None
+    assert heos_manager.get_device_by_pid(3) is None
+    assert [device.pid for device in heos_manager.get_all_devices()] == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_get_source_by_id_finds_nested_source(mock_heos, monkeypatch):
+    heos_manager = HeosDeviceManager()
+    await heos_manager.initialize(mock_heos.ips())
+
+    # a miss does not walk the tree again as long as no browse added a source
+    reindexed = list()
+    reindex_sources = heos_manager._reindex_sources
+    monkeypatch.setattr(heos_manager, "_reindex_sources", lambda: reindexed.append(reindex_sources()))
+    assert heos_manager.get_source_by_id(4096) is None
+    assert not reindexed
+
+    mock_heos.browse_results[(1024, "")].append({"name": "Nested", "type": "heos_service", "sid": 4096})
+    heos.sources.HeosSourceBase.browse_cache.invalidate(1024)
+    await heos_manager.get_source_by_id(1024).browse()
+    assert heos_manager.get_source_by_id(4096).name == "Nested"
+    assert heos_manager.get_source_by_id(5) is None
+    assert len(reindexed) == 1
+
+
+@pytest.mark.asyncio
+async def test_players_changed_keeps_devices_on_failed_reply(mock_heos, monkeypatch):
+    heos_manager = HeosDeviceManager()
+    await heos_manager.initialize(mock_heos.ips())
+
+    async def send_telnet_message(ip, command: bytes) -> dict:
+        return {"heos": {"command": "player/get_players", "result": "fail",
+                         "message": "eid=13&text=Processing previous command"}}
+
+    monkeypatch.setattr(HeosDeviceManager, "send_telnet_message", send_telnet_message)
+    with pytest.raises(heos.protocol.HeosProtocolError):
+        await heos_manager.update_players()
+    with pytest.raises(heos.protocol.HeosProtocolError):
+        await heos_manager.forget_ips([mock_heos.ips()[0]])
+
+    assert [device.pid for device in heos_manager.get_all_devices()] == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_system_events_run_in_background(mock_heos):
+    heos_manager = HeosDeviceManager()
+    await heos_manager.initialize(mock_heos.ips())
+    mock_heos.delay = 0.05
+    calls = len(mock_heos.calls)
+
+    # the reader is not held up by the scan, a burst of events scans the system only once more
+    start = time.perf_counter()
+    for _ in range(5):
+        await heos_manager._handle_event({"heos": {"command": "event/players_changed", "message": ""}})
+    assert time.perf_counter() - start < 0.05
+
+    mock_heos.players[0]["name"] = "Kitchen"
+    await heos_manager.wait_for_system_jobs()
+    assert heos_manager.get_device_by_name("Kitchen").pid == 1
+    assert sum(1 for _, command in mock_heos.calls[calls:] if b'get_players' in command) == 1
+
+
+@pytest.mark.asyncio
+async def test_sources_changed_updates_indexes(mock_heos):
+    heos_manager = HeosDeviceManager()
+    await heos_manager.initialize(mock_heos.ips())
+
+    mock_heos.sources.pop(0)
+    mock_heos.sources.append({"name": "USB", "type": "heos_server", "sid": 2048, "available": "true"})
+    await heos_manager._handle_event({"heos": {"command": "event/sources_changed", "message": ""}})
+    await heos_manager.wait_for_system_jobs()
+
+    assert heos_manager.get_source_by_id(1) is None
+    assert heos_manager.get_source_by_id(2048).name == "USB"
+    assert [source.sid for source in heos_manager.get_all_sources()] == [1024, 2048]
+
+
+@pytest.mark.asyncio
+async def test_source_data_changed_invalidates_browse_cache(mock_heos):
+    heos_manager = HeosDeviceManager()
+    await heos_manager.initialize(mock_heos.ips())
+    source = heos_manager.get_source_by_id(1024)
+
+    mock_heos.browse_results[(1024, "server")].append({"name": "New", "type": "song", "mid": "m2"})
+    await source.browse(1)
+    assert len(source.get_container("server").children) == 1
+
+    await heos_manager._handle_event({"heos": {"command": "event/source_data_changed", "message": "sid=1024"}})
+    await source.browse(1)
+    assert len(source.get_container("server").children) == 2
+
+
+@pytest.mark.asyncio
+async def test_restore_from_store(mock_heos, tmp_path):
+    store = HeosStateStore(str(tmp_path / "state.json.gz"))
+    heos_manager = HeosDeviceManager()
+    await heos_manager.initialize(mock_heos.ips())
+    await heos_manager.save(store)
+
+    calls = len(mock_heos.calls)
+    restored = HeosDeviceManager()
+    start = time.perf_counter()
+    assert await restored.restore(store)
+    elapsed = time.perf_counter() - start
+
+    assert len(mock_heos.calls) == calls
+    assert elapsed < 1
+    assert [device.to_dict() for device in restored.get_all_devices()] == \
+           [device.to_dict() for device in heos_manager.get_all_devices()]
+    assert [source.to_dict() for source in restored.get_all_sources()] == \
+           [source.to_dict() for source in heos_manager.get_all_sources()]
+    assert restored.get_source_by_id(1024).get_container("server")._sid == 1024
+
+
+@pytest.mark.asyncio
+async def test_restore_revalidates(mock_heos, tmp_path):
+    store = HeosStateStore(str(tmp_path / "state.json.gz"))
+    heos_manager = HeosDeviceManager()
+    await heos_manager.initialize(mock_heos.ips())
+    await heos_manager.save(store)
+
+    mock_heos.players[1]["name"] = "Kitchen"
+    mock_heos.state[1]["level"] = 50
+    mock_heos.browse_results[(1024, "server")].append({"name": "New", "type": "song", "mid": "m2"})
+
+    restored = HeosDeviceManager()
+    assert await restored.restore(store)
+    await restored.revalidate()
+
+    assert restored.get_device_by_name("Kitchen").pid == 2
+    assert restored.get_device_by_pid(1).volume == 50
+    assert len(restored.get_source_by_id(1024).get_container("server").children) == 2
+
+
+@pytest.mark.asyncio
+async def test_restore_follows_moved_speakers(mock_heos, tmp_path):
+    store = HeosStateStore(str(tmp_path / "state.json.gz"))
+    heos_manager = HeosDeviceManager()
+    await heos_manager.initialize(mock_heos.ips())
+    await heos_manager.save(store)
+
+    for player in mock_heos.players:
+        player["ip"] = "10.0.0." + str(player["pid"])
+
+    restored = HeosDeviceManager()
+    assert await restored.restore(store)
+    await restored.initialize(mock_heos.ips())
+
+    assert [device.ip for device in restored.get_all_devices()] == ["10.0.0.1", "10.0.0.2", "10.0.0.3"]
+    assert restored._ips == ["10.0.0.1", "10.0.0.2", "10.0.0.3"]
+    assert [source._ip for source in restored.get_all_sources()] == ["10.0.0.1", "10.0.0.1"]
+    assert restored.get_source_by_id(1024).get_container("server")._ip == "10.0.0.1"
+
+    calls = len(mock_heos.calls)
+    await restored.get_device_by_pid(2).set_volume(30)
+    heos.sources.HeosSourceBase.browse_cache.invalidate()
+    await restored.get_source_by_id(1024).get_container("server").browse()
+    assert [ip for ip, _ in mock_heos.calls[calls:]] == ["10.0.0.2", "10.0.0.1"]
+
+
+@pytest.mark.asyncio
+async def test_revalidate_watches_events_before_sources(mock_heos, tmp_path, monkeypatch):
+    store = HeosStateStore(str(tmp_path / "state.json.gz"))
+    heos_manager = HeosDeviceManager()
+    await heos_manager.initialize(mock_heos.ips())
+    await heos_manager.save(store)
+
+    steps = list()
+
+    async def start_watch_events(self):
+        steps.append("watch")
+
+    async def update_sources(self):
+        steps.append("sources")
+
+    monkeypatch.setattr(HeosDeviceManager, "start_watch_events", start_watch_events)
+    monkeypatch.setattr(HeosDeviceManager, "update_sources", update_sources)
+    restored = HeosDeviceManager()
+    assert await restored.restore(store)
+    await restored.revalidate()
+
+    assert steps == ["watch", "sources"]
+
+
+@pytest.mark.asyncio
+async def test_restore_without_store(tmp_path):
+    heos_manager = HeosDeviceManager()
+
+    assert not await heos_manager.restore(HeosStateStore(str(tmp_path / "missing.json.gz")))
+    assert not heos_manager.get_all_devices()
@@ -0,0 +1,110 @@
+import json
+
+import pytest
+
+from heos.protocol import HeosFrameDecoder, HeosMessage, HeosProtocolError
+
+
+def _frame(data: dict) -> bytes:
+    return json.dumps(data).encode('utf-8') + b"\r\n"
+
+
+def test_decoder_single_frame():
+    decoder = HeosFrameDecoder()
+    messages = decoder.feed(_frame({"heos": {"command": "system/heart_beat"}}))
+
+    assert messages == [{"heos": {"command": "system/heart_beat"}}]
+    assert decoder.pending == 0
+
+
+def test_decoder_several_frames_in_one_read():
+    decoder = HeosFrameDecoder()
+    messages = decoder.feed(_frame({"a": 1}) + _frame({"b": 2}) + _frame({"c": 3}))
+
+    assert messages == [{"a": 1}, {"b": 2}, {"c": 3}]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 64])
+def test_decoder_split_frames(chunk_size):
+    payload = [{"name": "Album " + str(i), "cid": "cid" + str(i), "container": "yes"} for i in range(200)]
+    stream = _frame({"heos": {"command": "browse/browse", "message": "かんじ"}, "payload": payload}) \
+        + _frame({"heos": {"command": "event/sources_changed"}})
+
+    decoder = HeosFrameDecoder()
+    messages = list()
+    for i in range(0, len(stream), chunk_size):
+        messages.extend(decoder.feed(stream[i:i + chunk_size]))
+
+    assert len(messages) == 2
+    assert messages[0]["payload"] == payload
+    assert messages[0]["heos"]["message"] == "かんじ"
+    assert messages[1]["heos"]["command"] == "event/sources_changed"
+    assert decoder.pending == 0
+
+
+def test_decoder_decodes_each_frame_once(monkeypatch):
+    calls = 0
+    decode = HeosFrameDecoder.decode
+
+    def counting_decode(frame):
+        nonlocal calls
+        calls += 1
+        return decode(frame)
+
+    monkeypatch.setattr(HeosFrameDecoder, "decode", staticmethod(counting_decode))
+
+    decoder = HeosFrameDecoder()
+    stream = _frame({"payload": [{"a": "}" * 10}] * 100})
+    for i in range(0, len(stream), 16):
+        decoder.feed(stream[i:i + 16])
+
+    assert calls == 1
+
+
+def test_decoder_invalid_utf8():
+    decoder = HeosFrameDecoder()
+    with pytest.raises(HeosProtocolError):
+        decoder.feed(b'{"heos": "\xff\xfe"}\r\n')
+
+
+def test_decoder_invalid_json():
+    decoder = HeosFrameDecoder()
+    with pytest.raises(HeosProtocolError):
+        decoder.feed(b'{"heos": \r\n')
+
+
+def test_decoder_recovers_after_invalid_frame():
+    decoder = HeosFrameDecoder()
+    with pytest.raises(HeosProtocolError):
+        decoder.feed(b'{"heos": \r\n')
+
+    assert decoder.feed(_frame({"a": 1})) == [{"a": 1}]
+
+
+def test_message_fields():
+    message = HeosMessage("pid=-1234&state=play&level=33&name=Living%20Room%26Kitchen&mute=on")
+
+    assert message.get("state") == "play"
+    assert message.get_int("pid") == -1234
+    assert message.get_int("level") == 33
+    assert message.get("name") == "Living Room&Kitchen"
+    assert message.get_bool("mute")
+    assert "level" in message
+    assert str(message) == message.raw
+
+
+def test_message_missing_fields():
+    message = HeosMessage("command under process&pid=1")
+
+    assert message.startswith("command under process")
+    assert message.get("state") is None
+    assert message.get("state", "stop") == "stop"
+    assert message.get_int("level", 5) == 5
+    assert message.get_int("pid") == 1
+    assert message.get_bool("mute") is None
+    assert HeosMessage("").fields == {}
+
+
+def test_message_parse_cached():
+    assert HeosMessage.parse("pid=1&level=2") is HeosMessage.parse("pid=1&level=2")
+    assert HeosMessage.parse("pid=1&level=2") == "pid=1&level=2"
@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+
+from heos.scheduler import HeosScheduler
+
+
+@pytest.mark.asyncio
+async def test_scheduler_limits():
+    scheduler = HeosScheduler(max_concurrency=3, max_concurrency_per_ip=2)
+    running = {"total": 0, "a": 0, "b": 0}
+    peak = {"total": 0, "a": 0, "b": 0}
+
+    def job(ip):
+        async def run():
+            running["total"] += 1
+            running[ip] += 1
+            peak["total"] = max(peak["total"], running["total"])
+            peak[ip] = max(peak[ip], running[ip])
+            await asyncio.sleep(0.01)
+            running["total"] -= 1
+            running[ip] -= 1
+            return ip
+
+        return ip, run
+
+    results = await scheduler.gather([job("a") for _ in range(5)] + [job("b") for _ in range(5)])
+
+    assert results == ["a"] * 5 + ["b"] * 5
+    assert peak == {"total": 3, "a": 2, "b": 2}
@@ -0,0 +1,96 @@
+import json
+
+from heos.manager import HeosDevice
+from heos.snapshot import HeosSnapshotCache
+from heos.sources import HeosSource, HeosSourceContainer
+
+
+def encode(obj) -> bytes:
+    return json.dumps({"name": obj.name}).encode()
+
+
+def get_device(pid: int) -> HeosDevice:
+    return HeosDevice({
+        'pid': pid,
+        'name': 'Device ' + str(pid),
+        'model': 'mock',
+        'version': '0.1',
+        'ip': '127.0.0.1',
+        'network': 'wlan',
+        'serial': '1234567890',
+    }, doUpdate=False)
+
+
+def test_snapshot_reencodes_only_dirty_objects():
+    devices = [get_device(1), get_device(2)]
+    encoded = list()
+
+    def counting_encode(obj) -> bytes:
+        encoded.append(obj.pid)
+        return encode(obj)
+
+    cache = HeosSnapshotCache()
+    body, etag = cache.get('devices', 'devices', devices, counting_encode)
+    assert json.loads(body) == [{"name": "Device 1"}, {"name": "Device 2"}]
+    assert encoded == [1, 2]
+
+    assert cache.get('devices', 'devices', devices, counting_encode) == (body, etag)
+    assert encoded == [1, 2]
+
+    devices[1].name = "Kitchen"
+    new_body, new_etag = cache.get('devices', 'devices', devices, counting_encode)
+    assert json.loads(new_body)[1] == {"name": "Kitchen"}
+    assert new_etag != etag
+    assert encoded == [1, 2, 2]
+
+
+def test_snapshot_private_attributes_keep_cache():
+    device = get_device(1)
+    cache = HeosSnapshotCache()
+    cache.get('devices', 'devices', [device], encode)
+
+    device._refresh_task = None
+    assert device._snapshot is not None
+
+
+def test_snapshot_child_marks_parents_dirty():
+    source = HeosSource("127.0.0.1", None, {"name": "Local Music", "type": "heos_server", "sid": 1024})
+    container = HeosSourceContainer("127.0.0.1", source, {"name": "Server", "type": "heos_server", "cid": "s"})
+    source.children["cid: s"] = container
+
+    cache = HeosSnapshotCache()
+    cache.get('sources', 'sources', [source], encode)
+    assert source._snapshot is not None
+
+    container.name = "Renamed"
+    assert source._snapshot is None
+
+
+def test_snapshot_if_none_match():
+    assert HeosSnapshotCache.matches('"abc"', '"abc"')
+    assert HeosSnapshotCache.matches('"x", W/"abc"', '"abc"')
+    assert HeosSnapshotCache.matches('*', '"abc"')
+    assert not HeosSnapshotCache.matches('"x"', '"abc"')
+    assert not HeosSnapshotCache.matches(None, '"abc"')
+
+
+def test_snapshot_versions_per_group():
+    device = get_device(1)
+    source = HeosSource("127.0.0.1", None, {"name": "Local Music", "type": "heos_server", "sid": 1024})
+    joined = list()
+
+    def objects(*items):
+        # a response taken from the cache does not look at its objects at all
+        for item in items:
+            joined.append(item.name)
+            yield item
+
+    cache = HeosSnapshotCache()
+    sources = cache.get('sources', 'sources', objects(source), encode)
+    cache.get('devices', 'devices', objects(device), encode)
+
+    # a progress tick of a device keeps the cached response of the sources
+    device.now_playing = {"cur_pos": 1000}
+    assert cache.get('sources', 'sources', objects(source), encode) == sources
+    cache.get('devices', 'devices', objects(device), encode)
+    assert joined == ["Local Music", "Device 1", "Device 1"]
@@ -1,4 +1,12 @@
-from heos.sources import HeosSearchCriteria, HeosSource
+import asyncio
+import time
+import tracemalloc
+
+import pytest
+
+from heos.cache import HeosBrowseCache
+from heos.manager import HeosDeviceManager
+from heos.sources import HeosSearchCriteria, HeosSource, HeosSourceBase, HeosSourceContainer, HeosSourceMusic
 
 
 def test_init_search_criteria():
@@ -47,3 +55,218 @@ def test_init_search_criteria2():
     assert not sc.allow_wildcard
     assert sc.is_playable
     assert sc.cid == "test123"
+
+
+def get_source_tree() -> HeosSource:
+    source = HeosSource("192.168.1.1", None, {"name": "Local Music", "type": "heos_server", "sid": 1024})
+    source.search_criteria.append(HeosSearchCriteria("192.168.1.1", 1024, {"scid": 1, "name": "Artist",
+                                                                           "wildcard": "no"}))
+    container = HeosSourceContainer("192.168.1.1", source, {"name": "Server", "type": "heos_server", "cid": "s"})
+    source.children["cid: s"] = container
+    container.children["mid: m1"] = HeosSourceMusic("192.168.1.1", container,
+                                                    {"name": "Track", "type": "song", "mid": "m1"})
+    return source
+
+
+def test_source_to_dict():
+    data = get_source_tree().to_dict()
+
+    assert data["sid"] == 1024
+    assert data["search_criteria"] == [{"scid": 1, "name": "Artist", "allow_wildcard": False,
+                                        "is_playable": False, "cid": 0}]
+    container = data["children"]["cid: s"]
+    assert container["cid"] == "s"
+    assert container["is_container"]
+    assert container["children"]["mid: m1"] == {"type": "song", "name": "Track", "mid": "m1",
+                                                "search_criteria": [], "children": {}}
+    assert "_ip" not in data and "_parent" not in container
+
+
+def test_source_to_dict_depth_and_fields():
+    source = get_source_tree()
+
+    assert "children" not in source.to_dict(depth=0)
+    assert "children" not in source.to_dict(depth=1)["children"]["cid: s"]
+    assert source.to_dict(["name", "children"]) == {
+        "name": "Local Music",
+        "children": {"cid: s": {"name": "Server", "children": {"mid: m1": {"name": "Track", "children": {}}}}},
+    }
+    assert source.to_dict(["name"], depth=5) == {"name": "Local Music"}
+
+
+@pytest.mark.slow
+def test_source_tree_memory():
+    # synthetic library of 100k nodes: albums with 100 tracks each, built like browse() does
+    tracemalloc.start()
+    source = HeosSource("192.168.1.1", None, {"name": "Local Music", "type": "heos_server", "sid": 1024})
+    count = 1
+    while count < 100000:
+        album = HeosSourceContainer("192.168.1.1", source, {"name": "Album " + str(count), "type": "album",
+                                                            "cid": "album" + str(count)})
+        source.children[album._id] = album
+        count += 1
+        for i in range(min(100, 100000 - count)):
+            # every decoded payload brings its own copy of the type string
+            track = HeosSourceMusic("192.168.1.1", album, {"name": "Track " + str(i), "type": "".join(("so", "ng")),
+                                                           "mid": "m" + str(count)})
+            album.children[track._id] = track
+            count += 1
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # about 310 bytes per node, it was 477 with a __dict__ and two empty containers per node
+    assert size / count < 360, f"{size / count:.0f} bytes per node"
+    assert not hasattr(track, "__dict__")
+    assert track._children is None and track._search_criteria is None
+    assert track.type is next(iter(album.children.values())).type
+
+
+def add_tracks(mock_heos, count: int):
+    mock_heos.browse_results[(1024, "server")] = [
+        {"name": "Track " + str(i), "type": "song", "mid": "m" + str(i), "container": "no"} for i in range(count)]
+
+
+@pytest.mark.asyncio
+async def test_browse_reads_every_page(mock_heos):
+    add_tracks(mock_heos, 250)
+    container = HeosSourceContainer("192.168.1.1", None, {"name": "Server", "type": "heos_server", "cid": "server"})
+    container._sid = 1024
+
+    await container.browse()
+
+    assert len(container.children) == 250
+    assert list(container.children)[-1] == "mid: m249"
+    assert [command for _, command in mock_heos.calls] == [
+        b'heos://browse/browse?sid=1024&cid=server&range=0,99',
+        b'heos://browse/browse?sid=1024&cid=server&range=100,199',
+        b'heos://browse/browse?sid=1024&cid=server&range=200,299',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_iter_children_fetches_on_demand(mock_heos):
+    add_tracks(mock_heos, 1000)
+    mock_heos.delay = 0.01
+    container = HeosSourceContainer("192.168.1.1", None, {"name": "Server", "type": "heos_server", "cid": "server"})
+    container._sid = 1024
+
+    names = list()
+    children = container.iter_children(offset=150)
+    async for child in children:
+        names.append(child.name)
+        if len(names) == 120:
+            break
+    await children.aclose()
+
+    assert names[0] == "Track 150" and names[-1] == "Track 269"
+    assert [command for _, command in mock_heos.calls] == [
+        b'heos://browse/browse?sid=1024&cid=server&range=150,249',
+        b'heos://browse/browse?sid=1024&cid=server&range=250,349',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_iter_children_prefetches_next_page(mock_heos):
+    add_tracks(mock_heos, 300)
+    mock_heos.delay = 0.05
+    container = HeosSourceContainer("192.168.1.1", None, {"name": "Server", "type": "heos_server", "cid": "server"})
+    container._sid = 1024
+
+    start = time.monotonic()
+    async for child in container.iter_children():
+        if child.mid in ("m0", "m100", "m200"):
+            # the caller works on the page while the next one is on its way
+            await asyncio.sleep(0.05)
+
+    # serial fetching and working takes 0.3s
+    assert time.monotonic() - start < 0.26
+
+
+@pytest.mark.asyncio
+async def test_browse_range_merges_page(mock_heos):
+    add_tracks(mock_heos, 1000)
+    container = HeosSourceContainer("192.168.1.1", None, {"name": "Server", "type": "heos_server", "cid": "server"})
+    container._sid = 1024
+
+    children, count = await container.browse_range(990, 50)
+
+    assert count == 1000
+    assert [child.mid for child in children] == ["m" + str(i) for i in range(990, 1000)]
+    assert list(container.children) == ["mid: m" + str(i) for i in range(990, 1000)]
+    assert mock_heos.count(b'browse/browse') == 1
+
+
+@pytest.mark.asyncio
+async def test_browse_uses_cache(mock_heos):
+    add_tracks(mock_heos, 150)
+    source = HeosSource("192.168.1.1", None, mock_heos.sources[1])
+
+    await source.browse(1)
+    calls = len(mock_heos.calls)
+    await source.browse(1)
+
+    assert len(mock_heos.calls) == calls
+    assert len(source.get_container("server").children) == 150
+
+    mock_heos.browse_results[(1024, "server")].pop()
+    await source.refresh()
+    assert len(source.get_container("server").children) == 149
+
+
+@pytest.mark.asyncio
+async def test_browse_tree_matches_serial_browse(mock_heos, monkeypatch):
+    mock_heos.delay = 0.01
+    mock_heos.browse_results = {(1024, ""): [
+        {"name": "Artist " + str(i), "type": "artist", "cid": "a" + str(i), "container": "yes"} for i in range(10)]}
+    for i in range(10):
+        mock_heos.browse_results[(1024, "a" + str(i))] = [
+            {"name": "Album " + str(j), "type": "album", "cid": "a" + str(i) + "-" + str(j), "container": "yes"}
+            for j in range(10)]
+        for j in range(10):
+            mock_heos.browse_results[(1024, "a" + str(i) + "-" + str(j))] = [
+                {"name": "Track " + str(k), "type": "song", "mid": "m" + str(i) + str(j) + str(k)} for k in range(5)]
+
+    running = {"now": 0, "max": 0}
+    send_telnet_message = mock_heos.send_telnet_message
+
+    async def count_running(ip, command):
+        running["now"] += 1
+        running["max"] = max(running["max"], running["now"])
+        try:
+            return await send_telnet_message(ip, command)
+        finally:
+            running["now"] -= 1
+
+    monkeypatch.setattr(HeosDeviceManager, "send_telnet_message", count_running)
+
+    serial = HeosSource("192.168.1.1", None, mock_heos.sources[1])
+    start = time.monotonic()
+    await serial.browse(2)
+    serial_time = time.monotonic() - start
+
+    monkeypatch.setattr(HeosSourceBase, "browse_cache", HeosBrowseCache())
+    running["max"] = 0
+    concurrent = HeosSource("192.168.1.1", None, mock_heos.sources[1])
+    start = time.monotonic()
+    await concurrent.browse_tree(2)
+    concurrent_time = time.monotonic() - start
+
+    assert concurrent.to_dict() == serial.to_dict()
+    assert len(concurrent.get_container("a9-9").children) == 5
+    assert running["max"] == HeosSourceBase.browse_concurrency
+    assert concurrent_time < serial_time / 3
+
+
+@pytest.mark.asyncio
+async def test_browse_range_keeps_browsed_children(mock_heos):
+    source = HeosSource("192.168.1.1", None, mock_heos.sources[1])
+    await source.browse(1)
+    server = source.get_container("server")
+    assert len(server.children) == 1
+
+    children, count = await source.browse_range(0, 10)
+
+    assert count == 1
+    assert children == [server]
+    assert source.get_container("server") is server
+    assert len(server.children) == 1
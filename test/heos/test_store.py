@@ -0,0 +1,50 @@
+import gzip
+import os
+
+import pytest
+
+from heos.store import HeosStateStore
+
+
+@pytest.mark.asyncio
+async def test_store_round_trip(tmp_path):
+    store = HeosStateStore(str(tmp_path / "state.json.gz"))
+    assert await store.load() is None
+
+    await store.save({"devices": [{"name": "Küche"}]})
+    assert await store.load() == {"devices": [{"name": "Küche"}], "version": HeosStateStore.version}
+    # only the target is left, the temporary file was renamed
+    assert os.listdir(str(tmp_path)) == ["state.json.gz"]
+
+
+@pytest.mark.asyncio
+async def test_store_ignores_other_versions(tmp_path, monkeypatch):
+    store = HeosStateStore(str(tmp_path / "state.json.gz"))
+    await store.save({"devices": []})
+
+    monkeypatch.setattr(HeosStateStore, "version", HeosStateStore.version + 1)
+    assert await store.load() is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("content", [b"", b"no gzip", gzip.compress(b"{broken"), gzip.compress(b"[]")])
+async def test_store_ignores_damaged_files(tmp_path, content):
+    path = tmp_path / "state.json.gz"
+    path.write_bytes(content)
+
+    assert await HeosStateStore(str(path)).load() is None
+
+
+def test_store_failed_write_keeps_old_file(tmp_path, monkeypatch):
+    store = HeosStateStore(str(tmp_path / "state.json.gz"))
+    store._write({"devices": [1]})
+
+    def failing_replace(source, target):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", failing_replace)
+    with pytest.raises(OSError):
+        store._write({"devices": [2]})
+
+    assert store._read()["devices"] == [1]
+    assert os.listdir(str(tmp_path)) == ["state.json.gz"]
@@ -0,0 +1,166 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from heos.connection import HeosConnectionPool
+from heos.manager import HeosDevice, HeosDeviceManager
+
+
+class MockEventSpeaker:
+    def __init__(self, ip: str):
+        self.ip = ip
+        self.silent = False
+        self.writers = list()
+        self.server = None
+
+    async def start(self, port: int = 0) -> int:
+        self.server = await asyncio.start_server(self.handle, self.ip, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        self.writers.append(writer)
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            if not self.silent:
+                command = line.strip().decode()[len("heos://"):].split("?")[0]
+                self.send(writer, {"heos": {"command": command, "result": "success", "message": ""}})
+
+    @staticmethod
+    def send(writer, data: dict):
+        writer.write(json.dumps(data).encode() + b"\r\n")
+
+    def send_event(self, event: str, message: str):
+        for writer in self.writers:
+            self.send(writer, {"heos": {"command": "event/" + event, "message": message}})
+
+    def drop(self):
+        for writer in self.writers:
+            writer.close()
+        self.writers = list()
+
+    def close(self):
+        self.drop()
+        self.server.close()
+
+
+@pytest.fixture
+def heos_manager(monkeypatch, mock_heos):
+    heos_manager = HeosDeviceManager()
+    for player, ip in zip(mock_heos.players, ("127.0.0.1", "127.0.0.2")):
+        device = HeosDevice(dict(player, ip=ip), doUpdate=False)
+        heos_manager.add_device(device)
+
+    subscription = heos_manager.event_subscription
+    subscription.heartbeat_interval = 0.1
+    subscription.heartbeat_timeout = 0.1
+    subscription.retry_interval = 0.05
+    yield heos_manager
+    subscription.stop()
+
+
+@pytest.fixture
+async def speakers(monkeypatch):
+    primary = MockEventSpeaker("127.0.0.1")
+    port = await primary.start()
+    secondary = MockEventSpeaker("127.0.0.2")
+    await secondary.start(port)
+    monkeypatch.setattr(HeosDeviceManager, "connection_pool", HeosConnectionPool(port=port))
+    yield primary, secondary
+    primary.close()
+    secondary.close()
+
+
+async def wait_for(condition, timeout: float = 2.0):
+    start = time.monotonic()
+    while not condition() and time.monotonic() - start < timeout:
+        await asyncio.sleep(0.01)
+    assert condition()
+
+
+@pytest.mark.asyncio
+async def test_subscription_receives_events(heos_manager, speakers):
+    primary, _ = speakers
+    await heos_manager.start_watch_events()
+    assert heos_manager.watch_enabled
+    assert heos_manager.event_subscription.primary_ip == "127.0.0.1"
+
+    primary.send_event("player_volume_changed", "pid=1&level=42&mute=off")
+    await wait_for(lambda: heos_manager._all_devices[1].volume == 42)
+
+    # heart beats are answered, so the subscription stays on the primary, their answers are no events
+    await asyncio.sleep(0.3)
+    assert heos_manager.event_subscription.failovers == 0
+    assert heos_manager.event_stats.count == 1
+
+
+@pytest.mark.asyncio
+async def test_subscription_fails_over_on_drop(heos_manager, speakers, mock_heos, caplog):
+    primary, secondary = speakers
+    await heos_manager.start_watch_events()
+
+    mock_heos.state[2]["level"] = 77
+    primary.close()
+
+    subscription = heos_manager.event_subscription
+    await wait_for(lambda: subscription.failovers == 1)
+    assert subscription.primary_ip == "127.0.0.2"
+    assert subscription.last_failover_time < 1
+    assert heos_manager._all_devices[2].volume == 77
+    assert subscription.stats()["missed_events"] > 0
+    assert "failed over from 127.0.0.1 to 127.0.0.2" in caplog.text
+
+    secondary.send_event("player_volume_changed", "pid=1&level=12&mute=off")
+    await wait_for(lambda: heos_manager._all_devices[1].volume == 12)
+
+
+@pytest.mark.asyncio
+async def test_subscription_fails_over_on_silence(heos_manager, speakers):
+    primary, _ = speakers
+    await heos_manager.start_watch_events()
+
+    primary.silent = True
+
+    subscription = heos_manager.event_subscription
+    await wait_for(lambda: subscription.failovers == 1)
+    assert subscription.primary_ip == "127.0.0.2"
+
+
+@pytest.mark.asyncio
+async def test_subscription_survives_failing_handler(heos_manager, speakers, monkeypatch):
+    primary, _ = speakers
+    await heos_manager.start_watch_events()
+
+    async def update_status(self):
+        raise ConnectionError("speaker went away")
+
+    monkeypatch.setattr(HeosDevice, "update_status", update_status)
+    primary.send_event("player_state_changed", "pid=1&state=play")
+    subscription = heos_manager.event_subscription
+    await wait_for(lambda: subscription.handler_errors == 1)
+
+    primary.send_event("player_volume_changed", "pid=1&level=33&mute=off")
+    await wait_for(lambda: heos_manager._all_devices[1].volume == 33)
+    assert subscription.failovers == 0
+
+
+@pytest.mark.asyncio
+async def test_subscription_survives_failing_resync(heos_manager, speakers, monkeypatch):
+    primary, secondary = speakers
+    await heos_manager.start_watch_events()
+
+    async def resync_devices():
+        raise asyncio.TimeoutError()
+
+    monkeypatch.setattr(heos_manager, "resync_devices", resync_devices)
+    primary.close()
+
+    subscription = heos_manager.event_subscription
+    await wait_for(lambda: subscription.failovers == 1)
+    assert subscription.handler_errors == 1
+
+    secondary.send_event("player_volume_changed", "pid=1&level=12&mute=off")
+    await wait_for(lambda: heos_manager._all_devices[1].volume == 12)
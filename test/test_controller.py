@@ -1,4 +1,6 @@
+import asyncio
 import json
+import time
 
 import pytest
 import quart
@@ -6,7 +8,11 @@ import quart.flask_patch
 import quart.testing
 
 import controller
+import heos
+import heos.cache
 import heos.manager
+import heos.protocol
+import heos.sources
 from controller import app as app_for_testing, convert_to_dict
 
 
@@ -16,7 +22,14 @@ class DummyHeos(heos.manager.HeosDevice):
         self.name = "Dummy"
         self.model = "Dummy"
         self.version = "123"
+        self.ip = "127.0.0.1"
+        self.network = "wired"
+        self.serial = "123"
+        self.play_state = "stop"
         self.volume = 0
+        self.is_muted = False
+        self.repeat = "off"
+        self.now_playing = dict()
 
     async def set_play_state(self, play_state: str) -> bool:
         return True
@@ -42,7 +55,7 @@ async def client() -> quart.app.QuartClient:
 @pytest.mark.timeout(20)
 async def test_scan_for_devices():
     await controller.scan_for_devices(2)
-    assert controller.found_heos_devices
+    assert controller.discovery.get_devices()
 
 
 @pytest.mark.asyncio
@@ -75,7 +88,7 @@ async def test_api_page_more(client: quart.app.QuartClient):
     if not controller.heos_manager:
         controller.heos_manager = heos.manager.HeosDeviceManager()
 
-    controller.heos_manager._all_devices["1234"] = DummyHeos()
+    controller.heos_manager.add_device(DummyHeos())
 
     response: quart.wrappers.Response
     response = await client.get('/api/')
@@ -90,6 +103,19 @@ async def test_api_page_more(client: quart.app.QuartClient):
     assert len(json_data["heos-devices"]) > 0
 
 
+@pytest.mark.asyncio
+async def test_heos_stats(client):
+    if not controller.heos_manager:
+        controller.heos_manager = heos.manager.HeosDeviceManager()
+
+    response = await client.get('/heos_stats/')
+    assert response.status_code == 200
+    data = json.loads(await response.get_data())
+    assert data["subscription"]["failovers"] == 0
+    assert set(data["connections"]) == {"open", "idle", "in_flight", "reconnects"}
+    assert "mean_latency_ms" in data["events"]
+
+
 @pytest.mark.asyncio
 @pytest.mark.device_needed
 async def test_devices_simple(client):
@@ -160,7 +186,7 @@ async def test_get_heos_device_by_name(client):
 
     if not controller.heos_manager:
         controller.heos_manager = heos.manager.HeosDeviceManager()
-    controller.heos_manager._all_devices["1234"] = DummyHeos()
+    controller.heos_manager.add_device(DummyHeos())
 
     response = await client.get('/heos_device/Dummy/')
     assert response.status_code == 200
@@ -181,7 +207,7 @@ async def test_get_heos_device_command_invalid(client, command):
 
     if not controller.heos_manager:
         controller.heos_manager = heos.manager.HeosDeviceManager()
-    controller.heos_manager._all_devices["1234"] = DummyHeos()
+    controller.heos_manager.add_device(DummyHeos())
 
     response = await client.get(command)
     assert response.status_code == 404
@@ -202,7 +228,282 @@ async def test_get_heos_device_command(client, command):
     if not controller.heos_manager:
         controller.heos_manager = heos.manager.HeosDeviceManager()
 
-    controller.heos_manager._all_devices["1234"] = DummyHeos()
+    controller.heos_manager.add_device(DummyHeos())
 
     response = await client.get(command)
     assert response.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_stream_events_burst_and_keep_alive():
+    subscriber = heos.EventQueueManager.subscribe()
+    stream = controller.stream_events(subscriber, keep_alive=0.05)
+
+    assert await stream.__anext__() == b': keep-alive\n\n'
+
+    for i in range(3):
+        heos.EventQueueManager.add_event(heos.ServerHeosEvent({"burst": i}))
+
+    chunk = await stream.__anext__()
+    assert chunk.count(b'Event: event') == 3
+    assert chunk.index(b'"burst":0') < chunk.index(b'"burst":2')
+
+    await stream.aclose()
+    assert subscriber.closed
+
+
+@pytest.mark.asyncio
+async def test_stream_events_resume_from_last_event_id():
+    first = heos.ServerHeosEvent("first")
+    second = heos.ServerHeosEvent("second")
+    heos.EventQueueManager.add_event(first)
+    heos.EventQueueManager.add_event(second)
+    assert second.id == first.id + 1
+
+    subscriber = heos.EventQueueManager.subscribe(last_event_id=first.id)
+    stream = controller.stream_events(subscriber, keep_alive=0.05)
+
+    chunk = await stream.__anext__()
+    assert b'id: ' + str(second.id).encode() in chunk
+    assert b'"first"' not in chunk
+    assert b'"second"' in chunk
+
+    await stream.aclose()
+
+
+@pytest.mark.asyncio
+async def test_stream_events_sends_disconnect_reason():
+    subscriber = heos.EventQueueManager.subscribe(heos.EventSubscriber.DISCONNECT)
+    stream = controller.stream_events(subscriber, keep_alive=0.05)
+
+    for i in range(heos.EventQueueManager.buffer_size + 1):
+        heos.EventQueueManager.add_event(heos.ServerHeosEvent(i))
+
+    chunks = [chunk async for chunk in stream]
+    assert chunks == [b': disconnected: slow subscriber, 2049 events behind\n\n']
+
+
+@pytest.mark.asyncio
+async def test_get_heos_event_stream_invalid_policy(client):
+    response = await client.get('/heos_events/?policy=unknown')
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_stream_events_filtered_and_coalesced():
+    subscriber = heos.EventQueueManager.subscribe()
+    stream = controller.stream_events(subscriber, keep_alive=0.05, event_filter=heos.EventFilter(pids=[1]),
+                                      coalesce=0.02)
+    next_chunk = asyncio.ensure_future(stream.__anext__())
+
+    for level in range(10):
+        heos.EventQueueManager.add_event(heos.ServerHeosEvent({
+            "event": "player_volume_changed", "message": "pid=1&level=" + str(level) + "&mute=off"}))
+        heos.EventQueueManager.add_event(heos.ServerHeosEvent({
+            "event": "player_volume_changed", "message": "pid=2&level=" + str(level) + "&mute=off"}))
+
+    chunk = await next_chunk
+    assert chunk.count(b'data: ') == 1
+    assert b'pid=1&level=9' in chunk
+
+    await stream.aclose()
+
+
+@pytest.mark.asyncio
+async def test_websocket_commands(client):
+    if not controller.heos_manager:
+        controller.heos_manager = heos.manager.HeosDeviceManager()
+    controller.heos_manager.add_device(DummyHeos())
+
+    async with client.websocket('/heos_ws/') as websocket:
+        await websocket.send(json.dumps({"id": 1, "command": "play", "device": "Dummy"}))
+        await websocket.send(json.dumps({"id": 2, "command": "volume", "device": "Dummy", "level": 20}))
+        await websocket.send(json.dumps({"id": 3, "command": "play", "device": "Unknown"}))
+        await websocket.send(json.dumps({"id": 4, "command": "state", "device": "Dummy"}))
+        await websocket.send("no json")
+
+        replies = dict()
+        for _ in range(5):
+            reply = json.loads(await websocket.receive())
+            assert reply["type"] == "reply"
+            replies[reply["id"]] = reply
+
+    assert replies[1]["successful"]
+    assert replies[2]["successful"]
+    assert not replies[3]["successful"]
+    assert replies[3]["error"] == "Device not found."
+    assert replies[4]["result"]["name"] == "Dummy"
+    assert not replies[None]["successful"]
+
+
+@pytest.mark.asyncio
+async def test_websocket_command_errors(client, monkeypatch):
+    if not controller.heos_manager:
+        controller.heos_manager = heos.manager.HeosDeviceManager()
+    controller.heos_manager.add_device(DummyHeos())
+
+    async def failing_command(self, *args):
+        raise failures.pop(0)
+
+    failures = [ConnectionError("speaker went away"), asyncio.TimeoutError(),
+                heos.protocol.HeosProtocolError("bad frame")]
+    monkeypatch.setattr(DummyHeos, "set_play_state", failing_command)
+
+    async with client.websocket('/heos_ws/') as websocket:
+        replies = list()
+        for i in range(3):
+            await websocket.send(json.dumps({"id": i, "command": "play", "device": "Dummy"}))
+            replies.append(json.loads(await websocket.receive()))
+
+    assert [reply["id"] for reply in replies] == [0, 1, 2]
+    assert not any(reply["successful"] for reply in replies)
+    assert [reply["error"] for reply in replies] == ["speaker went away", "TimeoutError", "bad frame"]
+
+
+@pytest.mark.asyncio
+async def test_websocket_events(client):
+    async with client.websocket('/heos_ws/', query_string={"pid": "1", "slim": "1"}) as websocket:
+        await websocket.send(json.dumps({"id": 1, "command": "unknown"}))
+        assert json.loads(await websocket.receive())["id"] == 1
+
+        heos.EventQueueManager.add_event(heos.ServerHeosEvent({
+            "event": "player_volume_changed", "message": "pid=2&level=3", "full": {}}))
+        heos.EventQueueManager.add_event(heos.ServerHeosEvent({
+            "event": "player_volume_changed", "message": "pid=1&level=4", "full": {}}))
+
+        event = json.loads(await asyncio.wait_for(websocket.receive(), 1))
+
+    assert event["type"] == "event"
+    assert event["data"] == {"event": "player_volume_changed", "message": "pid=1&level=4"}
+
+
+@pytest.mark.slow
+@pytest.mark.asyncio
+async def test_websocket_command_throughput(client):
+    if not controller.heos_manager:
+        controller.heos_manager = heos.manager.HeosDeviceManager()
+    controller.heos_manager.add_device(DummyHeos())
+    count = 200
+
+    start = time.perf_counter()
+    for _ in range(count):
+        response = await client.get('/heos_device/Dummy/volume_up/')
+        assert response.status_code == 200
+    rest_rate = count / (time.perf_counter() - start)
+
+    async with client.websocket('/heos_ws/') as websocket:
+        start = time.perf_counter()
+        for i in range(count):
+            await websocket.send(json.dumps({"id": i, "command": "volume_up", "device": "Dummy"}))
+        for _ in range(count):
+            assert json.loads(await websocket.receive())["successful"]
+        websocket_rate = count / (time.perf_counter() - start)
+
+    assert websocket_rate > rest_rate, f"REST: {rest_rate:.0f} commands/s, websocket: {websocket_rate:.0f} commands/s"
+
+
+@pytest.mark.asyncio
+async def test_set_heos_device_volume(client):
+    if not controller.heos_manager:
+        controller.heos_manager = heos.manager.HeosDeviceManager()
+    controller.heos_manager.add_device(DummyHeos())
+
+    response = await client.get('/heos_device/Dummy/volume/40/')
+    assert response.status_code == 200
+    data = json.loads(await response.get_data())
+    assert data["successful"]
+
+    response = await client.get('/heos_device/Unknown/volume/40/')
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_get_heos_devices_etag(client):
+    if not controller.heos_manager:
+        controller.heos_manager = heos.manager.HeosDeviceManager()
+    device = DummyHeos()
+    controller.heos_manager.add_device(device)
+
+    response = await client.get('/heos_devices/')
+    etag = response.headers['ETag']
+    assert response.status_code == 200
+
+    response = await client.get('/heos_devices/', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    device.volume = 33
+    response = await client.get('/heos_devices/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert any(item["volume"] == 33 for item in json.loads(await response.get_data()))
+
+
+@pytest.mark.asyncio
+async def test_get_heos_device_fields(client):
+    if not controller.heos_manager:
+        controller.heos_manager = heos.manager.HeosDeviceManager()
+    controller.heos_manager.add_device(DummyHeos())
+
+    response = await client.get('/heos_device/Dummy/?fields=name,volume')
+    assert json.loads(await response.get_data()) == {"name": "Dummy", "volume": 0}
+
+    response = await client.get('/heos_devices/?fields=pid')
+    assert {"pid": "1234"} in json.loads(await response.get_data())
+
+
+@pytest.mark.asyncio
+async def test_get_heos_source_container_page(client, monkeypatch):
+    async def send_telnet_message(ip, command: bytes) -> dict:
+        start, end = (int(value) for value in command.decode().rsplit("range=", 1)[1].split(","))
+        payload = [{"name": "Track " + str(i), "type": "song", "mid": "m" + str(i)}
+                   for i in range(start, min(end + 1, 500))]
+        return {"heos": {"command": "browse/browse", "result": "success",
+                         "message": f"returned={len(payload)}&count=500"}, "payload": payload}
+
+    monkeypatch.setattr(heos.manager.HeosDeviceManager, "send_telnet_message", send_telnet_message)
+    monkeypatch.setattr(heos.sources.HeosSourceBase, "browse_cache", heos.cache.HeosBrowseCache())
+    if not controller.heos_manager:
+        controller.heos_manager = heos.manager.HeosDeviceManager()
+    source = heos.sources.HeosSource("127.0.0.1", None, {"name": "Local", "type": "heos_server", "sid": 1030})
+    source.children["cid: big"] = heos.sources.HeosSourceContainer(
+        "127.0.0.1", source, {"name": "Big", "type": "album", "cid": "big"})
+    controller.heos_manager._all_sources[1030] = source
+    controller.heos_manager._reindex_sources()
+
+    response = await client.get('/heos_source/1030/big/?offset=480&limit=50')
+    data = json.loads(await response.get_data())
+
+    assert data["count"] == 500
+    assert data["offset"] == 480
+    assert list(data["children"]) == ["mid: m" + str(i) for i in range(480, 500)]
+
+
+@pytest.mark.asyncio
+async def test_get_heos_source_container_first_page(client, monkeypatch):
+    commands = list()
+
+    async def send_telnet_message(ip, command: bytes) -> dict:
+        commands.append(command)
+        start, end = (int(value) for value in command.decode().rsplit("range=", 1)[1].split(","))
+        payload = [{"name": "Album " + str(i), "type": "container", "cid": "c" + str(i)}
+                   for i in range(start, min(end + 1, 500))]
+        return {"heos": {"command": "browse/browse", "result": "success",
+                         "message": f"returned={len(payload)}&count=500"}, "payload": payload}
+
+    monkeypatch.setattr(heos.manager.HeosDeviceManager, "send_telnet_message", send_telnet_message)
+    monkeypatch.setattr(heos.sources.HeosSourceBase, "browse_cache", heos.cache.HeosBrowseCache())
+    if not controller.heos_manager:
+        controller.heos_manager = heos.manager.HeosDeviceManager()
+    source = heos.sources.HeosSource("127.0.0.1", None, {"name": "Local", "type": "heos_server", "sid": 1031})
+    source.children["cid: big"] = heos.sources.HeosSourceContainer(
+        "127.0.0.1", source, {"name": "Big", "type": "album", "cid": "big"})
+    controller.heos_manager._all_sources[1031] = source
+    controller.heos_manager._reindex_sources()
+
+    response = await client.get('/heos_source/1031/big/')
+    data = json.loads(await response.get_data())
+
+    # only the first page of the container, none of its children are browsed
+    assert len(commands) == 1
+    assert data["count"] == 500
+    assert len(data["children"]) == heos.sources.HeosSourceBase.page_size